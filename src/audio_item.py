@@ -5,7 +5,7 @@ from heimdall import supplies, demands
 from heimdall.predicates import *
 
 import mutagen
-from urlparse import urlparse
+from heimdall.stores import local_path
 from urllib import quote_plus, unquote_plus
 
 class ExtractTags(tasks.SubjectTask):
@@ -22,7 +22,7 @@ class ExtractTags(tasks.SubjectTask):
     ]
 
     def run(self):
-        uri = urlparse(self.subject[dc.identifier]).path
+        uri = local_path(self.subject[dc.identifier])
 
         if uri:
             f = mutagen.File(uri, easy=True)
@@ -66,6 +66,69 @@ def comparePlatforms(platform1, platform2):
     # Finally, compare without spaces so that "game boy" matches "gameboy"
     return platform1.replace(" ", "") == platform2.replace(" ", "")
 
+# Source: http://www.file-extensions.org/filetype/extension/name/emulator-files
+ext_to_platform = {
+    "32x":    "Sega Genesis",      # Sega GENESIS ROM image file
+    "64b":    "Commodore 64",      # Commodore C64 emulator file
+    "64c":    "Commodore 64",      # Commodore C64 emulator file
+    "a26":    "Atari 2600",        # Atari 2600 ROM image file
+    "agb":    "Game Boy Advance",  # Nintendo Game Boy Advance ROM image
+    "adf":    "Amiga",             # Amiga disk file
+    "atr":    "Atari 8-bit",       # Atari 8-bit disk image
+    "boxer":  "Mac",               # Boxer for Mac game archive file
+    "bsx":    "Super Nintendo",    # Snes9x-Next emulator ROM image
+    "c64":    "Commodore 64",      # Commodore 64 ROM image
+    "cgb":    "Game Boy Color",    # Nintendo GameBoy Color emulator ROM image file
+    "chd":    "Arcade",            # MAME compressed hard disk file
+    "dhf":    "Amiga",             # AMIGA emulator disk image ROM file
+    "dx2":    "Super Nintendo",    # Snes9x-Next emulator ROM image
+    "fam":    "NES",               # Nintendo Entertainment System Famicom emulator ROM image
+    "fdi":    "Amiga",             # Amiga disk file
+    "fds":    "NES",               # Nintendo Famicom (NES) disk system file
+    "fig":    "Super Nintendo",    # Super Nintendo game-console ROM image
+    "g64":    "Commodore 64",      # C64 emulator disk image file
+    "gb":     "Game Boy",          # Nintendo Gameboy ROM image
+    "gba":    "Game Boy Advance",  # Nintendo Game Boy Advance ROM image
+    "gbc":    "Game Boy Color",    # Nintendo GameBoy Color emulator ROM image file
+    "gcz":    "GameCube",          # Dolphin emulator archive
+    "gcn":    "GameCube",
+    "gd3":    "Super Nintendo",    # Snes9x-Next emulator ROM image
+    "gd7":    "Super Nintendo",    # Snes9x-Next emulator ROM image
+    "ggs":    "Game Boy",          # Gameboy emulator file
+    "hdf":    "ZX Spectrum",       # ZX Spectrum IDE hard drive image file
+    "hdz":    "Amiga",             # Amiga hard disk image file
+    "jma":    "Super Nintendo",    # Snes9x emulator ROM image
+    "lnx":    "Atari Lynx",        # Atari Lynx ROM image file
+    "mgt":    "ZX Spectrum",       # ZX Spectrum emulator disk image
+    "n64":    "Nintendo 64",       # Nintendo 64 Emulation ROM image file
+    "nd5":    "Nintendo DS",       # Nintendo DS game ROM file
+    "nds":    "Nintendo DS",       # Nintendo DS game ROM image file
+    "nes":    "NES",               # Nintendo Entertainment System ROM image
+    "nez":    "NES",               # NES ROM emulator image file
+    "ngc":    "GameCube",
+    "ngp":    "Neo Geo",           # Neo Geo Pocket ROM image file
+    "pce":    "TurboGrafx 16",     # Mednafen PC Engine file
+    "pro":    "Atari 8-bit",       # APE Atari disk image file
+    "sc":     "Sega SC-3000",      # Sega SC-3000 image file
+    "sf7":    "Sega SF-7000",      # Sega SF-7000 ROM file
+    "sfc":    "Super Nintendo",    # Nintendo SNES9x ROM file
+    "sgb":    "Super Game Boy",    # Super Gameboy image file
+    "smc":    "Super Nintendo",    # Super Nintendo game-console ROM image
+    "smd":    "Sega Genesis",      # Sega Genesis ROM emulator file
+    "st":     "Atari ST",          # Atari disk image file
+    "swc":    "Super Nintendo",    # Snes9x-Next emulator ROM image
+    "trd":    "ZX Spectrum",       # TR-DOS ZX Spectrum floppy disk image
+    "ttp":    "Atari Falcon",      # Atari Falcon application
+    "u00":    "Commodore 64",      # Commodore C64 universal file
+    "unif":   "NES",               # FCEU-Next emulator ROM image
+    "v64":    "Nintendo 64",       # Nintento 64 emulation ROM image file
+    "vb":     "Virtual Boy",       # Virtual Boy image file
+    "wdf":    "Wii",               # Wiimm Nintendo Wii disc file
+    "whd":    "Amiga",             # WinUAEX Amiga game ROM file
+    "ws":     "WonderSwan",
+    "wsc":    "WonderSwan Color",
+    "x64":    "Commodore 64",      # Commodore 64 emulator disk image
+}
 
 class ResolvePlatform(tasks.SubjectTask):
     demand = [
@@ -83,70 +146,6 @@ class ResolvePlatform(tasks.SubjectTask):
         path = urlparse.urlparse(self.subject[dc.identifier]).path
         ext = path[path.rindex(".") + 1 : ].lower() if "." in path else ""
 
-        # Source: http://www.file-extensions.org/filetype/extension/name/emulator-files
-        ext_to_platform = {
-            "32x":    "Sega Genesis",      # Sega GENESIS ROM image file
-            "64b":    "Commodore 64",      # Commodore C64 emulator file
-            "64c":    "Commodore 64",      # Commodore C64 emulator file
-            "a26":    "Atari 2600",        # Atari 2600 ROM image file
-            "agb":    "Game Boy Advance",  # Nintendo Game Boy Advance ROM image
-            "adf":    "Amiga",             # Amiga disk file
-            "atr":    "Atari 8-bit",       # Atari 8-bit disk image
-            "boxer":  "Mac",               # Boxer for Mac game archive file
-            "bsx":    "Super Nintendo",    # Snes9x-Next emulator ROM image
-            "c64":    "Commodore 64",      # Commodore 64 ROM image
-            "cgb":    "Game Boy Color",    # Nintendo GameBoy Color emulator ROM image file
-            "chd":    "Arcade",            # MAME compressed hard disk file
-            "dhf":    "Amiga",             # AMIGA emulator disk image ROM file
-            "dx2":    "Super Nintendo",    # Snes9x-Next emulator ROM image
-            "fam":    "NES",               # Nintendo Entertainment System Famicom emulator ROM image
-            "fdi":    "Amiga",             # Amiga disk file
-            "fds":    "NES",               # Nintendo Famicom (NES) disk system file
-            "fig":    "Super Nintendo",    # Super Nintendo game-console ROM image
-            "g64":    "Commodore 64",      # C64 emulator disk image file
-            "gb":     "Game Boy",          # Nintendo Gameboy ROM image
-            "gba":    "Game Boy Advance",  # Nintendo Game Boy Advance ROM image
-            "gbc":    "Game Boy Color",    # Nintendo GameBoy Color emulator ROM image file
-            "gcz":    "GameCube",          # Dolphin emulator archive
-            "gcn":    "GameCube",
-            "gd3":    "Super Nintendo",    # Snes9x-Next emulator ROM image
-            "gd7":    "Super Nintendo",    # Snes9x-Next emulator ROM image
-            "ggs":    "Game Boy",          # Gameboy emulator file
-            "hdf":    "ZX Spectrum",       # ZX Spectrum IDE hard drive image file
-            "hdz":    "Amiga",             # Amiga hard disk image file
-            "jma":    "Super Nintendo",    # Snes9x emulator ROM image
-            "lnx":    "Atari Lynx",        # Atari Lynx ROM image file
-            "mgt":    "ZX Spectrum",       # ZX Spectrum emulator disk image
-            "n64":    "Nintendo 64",       # Nintendo 64 Emulation ROM image file
-            "nd5":    "Nintendo DS",       # Nintendo DS game ROM file
-            "nds":    "Nintendo DS",       # Nintendo DS game ROM image file
-            "nes":    "NES",               # Nintendo Entertainment System ROM image
-            "nez":    "NES",               # NES ROM emulator image file
-            "ngc":    "GameCube",
-            "ngp":    "Neo Geo",           # Neo Geo Pocket ROM image file
-            "pce":    "TurboGrafx 16",     # Mednafen PC Engine file
-            "pro":    "Atari 8-bit",       # APE Atari disk image file
-            "sc":     "Sega SC-3000",      # Sega SC-3000 image file
-            "sf7":    "Sega SF-7000",      # Sega SF-7000 ROM file
-            "sfc":    "Super Nintendo",    # Nintendo SNES9x ROM file
-            "sgb":    "Super Game Boy",    # Super Gameboy image file
-            "smc":    "Super Nintendo",    # Super Nintendo game-console ROM image
-            "smd":    "Sega Genesis",      # Sega Genesis ROM emulator file
-            "st":     "Atari ST",          # Atari disk image file
-            "swc":    "Super Nintendo",    # Snes9x-Next emulator ROM image
-            "trd":    "ZX Spectrum",       # TR-DOS ZX Spectrum floppy disk image
-            "ttp":    "Atari Falcon",      # Atari Falcon application
-            "u00":    "Commodore 64",      # Commodore C64 universal file
-            "unif":   "NES",               # FCEU-Next emulator ROM image
-            "v64":    "Nintendo 64",       # Nintento 64 emulation ROM image file
-            "vb":     "Virtual Boy",       # Virtual Boy image file
-            "wdf":    "Wii",               # Wiimm Nintendo Wii disc file
-            "whd":    "Amiga",             # WinUAEX Amiga game ROM file
-            "ws":     "WonderSwan",
-            "wsc":    "WonderSwan Color",
-            "x64":    "Commodore 64",      # Commodore 64 emulator disk image
-        }
-
         platform = ext_to_platform.get(ext)
         if platform:
             self.subject.extendClass("item.game")
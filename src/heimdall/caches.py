@@ -0,0 +1,163 @@
+from utils import thread_connection
+
+from collections import OrderedDict
+import sqlite3
+import threading
+import time
+
+import logging
+log = logging.getLogger("heimdall.caches")
+
+class MemoryCache(object):
+    """
+    A thread safe in-memory cache of strings, bounded to maxBytes by evicting
+    the least recently used entries. Every entry expires after its own ttl in
+    seconds, defaultTTL if not given. Counts hits, misses and evictions.
+    """
+    def __init__(self, maxBytes = 32 * 1024 * 1024, defaultTTL = 300):
+        self.maxBytes = maxBytes
+        self.defaultTTL = defaultTTL
+
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # Key -> (expires, value), least recently used first
+        self.size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Returns the value cached for key or None if missing or expired.
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+
+            if entry == None:
+                self.misses += 1
+                return None
+            elif entry[0] <= time.time():
+                self.size -= len(entry[1])
+                self.misses += 1
+                return None
+
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, ttl = None):
+        ttl = self.defaultTTL if ttl == None else ttl
+        if ttl <= 0 or len(value) > self.maxBytes:
+            return
+
+        with self.lock:
+            self._remove(key)
+
+            self.entries[key] = (time.time() + ttl, value)
+            self.size += len(value)
+
+            while self.size > self.maxBytes:
+                evicted, entry = self.entries.popitem(last=False)
+                self.size -= len(entry[1])
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self.lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry != None:
+            self.size -= len(entry[1])
+
+    def stats(self):
+        with self.lock:
+            return { "hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": len(self.entries), "bytes": self.size }
+
+class DiskCache(object):
+    """
+    A cache of strings stored in a single sqlite database at path, safe to
+    share between threads and processes. Writes are atomic and the total size
+    is bounded to maxBytes by evicting the least recently used entries. An
+    entry expires at its expires timestamp, or never if None. Entries may keep
+    the HTTP validators (ETag and Last-Modified) they were served with, so
+    expired entries can be revalidated and touched instead of replaced.
+    """
+
+    # Only refresh the access time of an entry if older than this, saving a write on most hits
+    accessResolution = 60
+
+    def __init__(self, path, maxBytes = 512 * 1024 * 1024):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.local = threading.local()
+
+    def _connection(self):
+        # With recursive_triggers replaced rows fire the delete trigger too
+        return thread_connection(self.local, self.path, """
+            CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, expires REAL, accessed REAL, size INTEGER, etag TEXT, modified TEXT);
+            CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+            CREATE TABLE IF NOT EXISTS total (size INTEGER);
+            INSERT INTO total SELECT COALESCE(SUM(size), 0) FROM entries WHERE NOT EXISTS (SELECT 1 FROM total);
+            CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN UPDATE total SET size = size + NEW.size; END;
+            CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN UPDATE total SET size = size - OLD.size; END;
+        """, ("recursive_triggers=ON", ))
+
+    def lookup(self, key):
+        """
+        Returns the value, expiry timestamp, ETag and Last-Modified of key, or
+        None if missing. Expired entries are returned too.
+        """
+        connection = self._connection()
+        row = connection.execute("SELECT value, expires, accessed, etag, modified FROM entries WHERE key = ?", (key, )).fetchone()
+        if row == None:
+            return None
+
+        now = time.time()
+        if row[2] < now - self.accessResolution:
+            with connection:
+                connection.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+
+        return str(row[0]), row[1], row[3], row[4]
+
+    def get(self, key):
+        """
+        Returns the value cached for key or None if missing or expired.
+        """
+        entry = self.lookup(key)
+        if entry == None or (entry[1] != None and entry[1] <= time.time()):
+            return None
+        return entry[0]
+
+    def put(self, key, value, expires = None, etag = None, modified = None):
+        if len(value) > self.maxBytes:
+            self.invalidate(key) # Whatever is cached is older than value
+            return
+
+        connection = self._connection()
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO entries (key, value, expires, accessed, size, etag, modified) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, sqlite3.Binary(value), expires, time.time(), len(value), etag, modified))
+
+            size = connection.execute("SELECT size FROM total").fetchone()[0]
+            while size > self.maxBytes:
+                row = connection.execute("SELECT key, size FROM entries ORDER BY accessed LIMIT 1").fetchone()
+                if row == None:
+                    break
+                connection.execute("DELETE FROM entries WHERE key = ?", (row[0], ))
+                size -= row[1]
+
+    def touch(self, key, expires = None, etag = None, modified = None):
+        """
+        Extends the entry of key until expires without rewriting its value,
+        replacing its validators if given.
+        """
+        connection = self._connection()
+        with connection:
+            connection.execute("UPDATE entries SET expires = ?, accessed = ?, etag = COALESCE(?, etag), modified = COALESCE(?, modified) WHERE key = ?",
+                (expires, time.time(), etag, modified, key))
+
+    def invalidate(self, key):
+        connection = self._connection()
+        with connection:
+            connection.execute("DELETE FROM entries WHERE key = ?", (key, ))
@@ -1,35 +1,30 @@
 import tasks
 import taskqueues
+import threadpools
 import demands, supplies
+from utils import extends_class
+from predicates import rdf, dc, intern_predicate, predicateIds, predicateUris
 
 import json
 import types
 import threading
-import re
 from collections import defaultdict
-from itertools import permutations
-from itertools import combinations
 
-import logging
-log = logging.getLogger("heimdall.core")
-
-def isolate_if_single(d):
-	if d == None or len(d) == 0:
-		return None
-	elif len(d) == 1:
-		return d[0]
-	else:
-		return d
-
-def find_doable_tasks(subject, given_tasks):
-	return [t for t in given_tasks if all([d.matches(subject) for d in t.demand])]
+try:
+	from concurrent.futures import Future
+except ImportError:
+	Future = None
 
-def find_impossible_tasks(subject, given_tasks):
-	return [t for t in given_tasks if any([d.matches(subject) == demands.match.NEVER for d in t.demand])]
+try:
+	import asyncio
+except ImportError:
+	try:
+		import trollius as asyncio
+	except ImportError:
+		asyncio = None
 
-def purge_impossible_tasks(subject, given_tasks):
-	impossible_tasks = find_impossible_tasks(subject, given_tasks)
-	return [t for t in given_tasks if t not in impossible_tasks]
+import logging
+log = logging.getLogger("heimdall.core")
 
 def conflicts(this, that):
 	for ss in this.supply:
@@ -39,55 +34,123 @@ def conflicts(this, that):
 
 	return False
 
-def find_conflicting_tasks(given_tasks):
-	conflicting_tasks = list()
+def supplies_class(supply):
+	return isinstance(supply, supplies.ugpradeClass) or getattr(supply, "predicate", None) == rdf.Class
 
-	for c in permutations(given_tasks, 2):
-		if c[0] != c[1] and conflicts(c[0], c[1]):
-			conflicting_tasks.append(c[0])
+def provides(supplier, demander):
+	for d in demander.demand:
+		for s in supplier.supply:
+			if s.matches(d) or (isinstance(d, demands.requiredClass) and supplies_class(s)):
+				return True
 
-	return set(conflicting_tasks)
+	return False
+
+class Values(list):
+	"""
+	Objects of a predicate emitted more than once, a single object is stored
+	as it is.
+	"""
+	__slots__ = ()
 
-def purge_conflicting_tasks(tasks):
-	conflicting_tasks = find_conflicting_tasks(tasks)
-	return [t for t in tasks if t not in conflicting_tasks]
+# Guards changing single objects into Values, which is not atomic
+valuesLock = threading.Lock()
 
 class Subject(object):
-	def __init__(self, Class = "", metadata = {}):
+	"""
+	Metadata about a resource as objects of predicates, kept small since very
+	many subjects may be alive at once. Objects are keyed by predicate ids,
+	see predicates.intern_predicate, and a predicate with a single object
+	stores it without a list. With unique, emitting an object a predicate
+	already has is ignored.
+	"""
+	__slots__ = ("Class", "values", "changes", "unique")
+
+	def __init__(self, Class = "", metadata = {}, unique = False):
 		self.Class = Class
-		self.metadata = defaultdict(list)
+		self.values = dict() # Predicate id -> object or Values
+		self.changes = list() # Predicates changed since last popChanges
+		self.unique = unique
 
 		for key, value in metadata.items():
-			self.metadata[key].append(value)
+			self._add(intern_predicate(key), value)
+
+	@property
+	def metadata(self):
+		"""
+		Copy of all objects as lists keyed by predicate.
+		"""
+		return dict((predicateUris[pid], list(value) if type(value) is Values else [ value ]) for pid, value in self.values.items())
 
 	def to_dict(self):
 		s = dict()
-		for key, value in self.metadata.items():
-			value = isolate_if_single(value)
+		for pid, value in self.values.items():
 			if value:
-				s[key] = value
+				s[predicateUris[pid]] = list(value) if type(value) is Values else value
 
 		return s
 
 	def __getitem__(self, name):
 		# No lock since pythons dict should be thread safe
-		return isolate_if_single(self.metadata.get(name, None))
+		pid = predicateIds.get(name)
+		return self.values.get(pid) if pid != None else None
+
+	def lookup(self, pid):
+		"""
+		Returns the object, or Values if several, of the predicate with id pid.
+		"""
+		return self.values.get(pid)
+
+	def _add(self, pid, object):
+		with valuesLock:
+			value = self.values.get(pid)
+			if value == None:
+				self.values[pid] = object
+			elif type(value) is Values:
+				if not (self.unique and object in value):
+					value.append(object)
+			elif not (self.unique and value == object):
+				self.values[pid] = Values((value, object))
 
 	def emit(self, predicate, object):
 		if object != None and object != "":
-			self.metadata[predicate].append(object)
+			self._add(intern_predicate(predicate), object)
+			self.changes.append(predicate)
 
 	def replace(self, predicate, object):
-		if predicate in self.metadata:
-			del self.metadata[predicate]
-		if object:
-			self.metadata[predicate].append(object)
-
+		pid = intern_predicate(predicate)
+		with valuesLock:
+			self.values.pop(pid, None)
+			if object:
+				self.values[pid] = object
+		self.changes.append(predicate)
+
+	def popChanges(self):
+		"""
+		Returns the set of predicates changed since last call.
+		"""
+		changed = set()
+		try:
+			while True:
+				changed.add(self.changes.pop())
+		except IndexError:
+			pass
+
+		return changed
+
+	def __getstate__(self):
+		# Predicate ids are per process, pickle by uri
+		return self.Class, dict((predicateUris[pid], value) for pid, value in self.values.items()), self.unique
+
+	def __setstate__(self, state):
+		self.Class, values, self.unique = state
+		self.values = dict((intern_predicate(uri), value) for uri, value in values.items())
+		self.changes = list()
 
 	def extendClass(self, Class):
-		if re.match(self.Class, Class): # Input class is extended version of sought class, upgrade
+		if extends_class(Class, self.Class): # Input class is extended version of sought class, upgrade
 			self.Class = Class
-		elif not re.match(Class, self.Class): # Input class is a not less extended version of sought class, diamond problem
+			self.changes.append(rdf.Class)
+		elif not extends_class(self.Class, Class): # Input class is a not less extended version of sought class, diamond problem
 			raise ValueError("{0} cannot extend to {1}, diamond problem".format(Class, self.Class))
 
 	def __repr__(self):
@@ -98,62 +161,437 @@ class Subject(object):
 
 		return json.dumps(s, sort_keys=True, indent=4)
 
+class ConflictMatrix(object):
+	"""
+	Pairwise conflicts between task classes, each task is given a bit and its
+	mask holds the bits of every task it conflicts with. Conflicts only depend
+	on the task classes so new tasks are added incrementally, only pairs
+	involving them are computed.
+	"""
+	def __init__(self):
+		self.bits = dict()
+		self.masks = dict()
+
+	def add(self, new_tasks):
+		for t in new_tasks:
+			if t in self.bits:
+				continue
+
+			self.bits[t] = 1 << len(self.bits)
+			self.masks[t] = 0
+
+			for o in self.bits.keys():
+				if o == t:
+					continue
+				if conflicts(t, o):
+					self.masks[t] |= self.bits[o]
+				if conflicts(o, t):
+					self.masks[o] |= self.bits[t]
+
+	def mask(self, given_tasks):
+		m = 0
+		for t in given_tasks:
+			m |= self.bits[t]
+		return m
+
+	def conflicts(self, this, that):
+		return self.masks[this] & self.bits[that] != 0
+
+	def purge(self, given_tasks, running_tasks = []):
+		"""
+		Removes tasks conflicting with another given task, or in any direction
+		with an already running task.
+		"""
+		m = self.mask(given_tasks) | self.mask(running_tasks)
+
+		blocked = 0
+		for r in running_tasks:
+			blocked |= self.masks[r]
+
+		return [t for t in given_tasks if self.masks[t] & m == 0 and self.bits[t] & blocked == 0]
+
+class SchedulingPlan(object):
+	"""
+	A compiled view of the registered subject tasks. Everything which only
+	depends on the task classes is worked out once, leaving the dispatcher to
+	evaluate only what depends on the subject itself.
+	"""
+	def __init__(self, subjectTasks, conflictMatrix = None):
+		self.tasks = list(subjectTasks)
+
+		self.conflicts = conflictMatrix if conflictMatrix != None else ConflictMatrix()
+		self.conflicts.add(self.tasks)
+
+		self.providers = dict() # Task -> tasks which may supply what it demands
+		self.dependents = dict() # Task -> tasks which demands what it may supply
+		self.predicateDemands = dict() # Task -> demands not on the subject class
+		self.demandIndex = defaultdict(set) # Predicate -> tasks with demands on it
+		self.candidates = dict() # Subject class -> (possible tasks, class ready tasks)
+
+		for t in self.tasks:
+			self.providers[t] = set()
+			self.dependents[t] = set()
+			self.predicateDemands[t] = [d for d in t.demand if not isinstance(d, demands.requiredClass)]
+
+			for d in t.demand:
+				self.demandIndex[rdf.Class if isinstance(d, demands.requiredClass) else d.predicate].add(t)
+
+		for t in self.tasks:
+			for o in self.tasks:
+				if t == o:
+					continue
+
+				if provides(o, t):
+					self.providers[t].add(o)
+					self.dependents[o].add(t)
+
+	def candidatesFor(self, Class):
+		"""
+		Returns which tasks may ever run on a subject of Class and which of
+		those already have their class demands met. Since a subject class only
+		is extended this is cached per class.
+		"""
+		# No lock, worst case two dispatchers compiles the same entry
+		candidates = self.candidates.get(Class, None)
+		if candidates == None:
+			probe = Subject(Class)
+			possible = set()
+			ready = set()
+
+			for t in self.tasks:
+				classMatches = [d.matches(probe) for d in t.demand if isinstance(d, demands.requiredClass)]
+				if demands.match.NEVER not in classMatches:
+					possible.add(t)
+					if all(classMatches):
+						ready.add(t)
+
+			candidates = (possible, ready)
+			self.candidates[Class] = candidates
+
+		return candidates
+
+	def touchedBy(self, predicates):
+		"""
+		Returns the tasks which has demands on any of the given predicates.
+		"""
+		touched = set()
+		for p in predicates:
+			touched.update(self.demandIndex.get(p, ()))
+
+		return touched
+
+	def matches(self, task, subject):
+		return all([d.matches(subject) for d in self.predicateDemands[task]])
+
+	def findDoableTasks(self, subject, given_tasks, matched, running_tasks = []):
+		"""
+		Returns possible tasks, those which have not become impossible, and the
+		doable ones among them which does not conflict with each other. Whether
+		the predicate demands of a task are met is looked up in matched.
+		A task is held back while any task which may supply what it demands, or
+		which it conflicts with, is among the running tasks.
+		"""
+		possible, ready = self.candidatesFor(subject.Class)
+
+		possible_tasks = [t for t in given_tasks if t in possible]
+		doable_tasks = [t for t in possible_tasks if t in ready and matched[t] and self.providers[t].isdisjoint(running_tasks)]
+
+		return possible_tasks, self.conflicts.purge(doable_tasks, running_tasks)
+
 class SubjectTaskDispatcher(object):
-	def __init__(self, subject, subjectTasks, taskQueue, callback):
+	"""
+	Runs the tasks of a plan on a subject. By default tasks are run in waves,
+	the next wave is scheduled when all tasks of the previous are done. In
+	dataflow mode every finished task triggers scheduling, launching any task
+	which became doable without waiting for unrelated running tasks.
+	"""
+	def __init__(self, subject, plan, taskQueue, callback, dataflow = False):
 		self.condition = threading.Condition()
 
 		self.subject = subject
 		self.callback = callback
+		self.dataflow = dataflow
+		self.finished = False
 
+		self.plan = plan
 		self.runningTasks = list()
-		self.availableTasks = [t for t in subjectTasks]
+		self.availableTasks = [t for t in plan.tasks]
+		self.matched = None # Task -> if its predicate demands are met
 
 		self.taskQueue = taskQueue
 
 		self.task_path = list() # For debugging purposes
 
-		self._scheduleNonConflictingTasks()
+		# Launched tasks may finish before all are launched, lock in the same
+		# order as when the task queue calls onDone
+		with self.taskQueue.condition:
+			with self.condition:
+				self._scheduleNonConflictingTasks()
+
+	def _updateMatches(self):
+		"""
+		Re-matches the demands of the available tasks which are touched by
+		predicates changed on the subject since last update.
+		"""
+		changed = self.subject.popChanges()
+
+		if self.matched == None:
+			self.matched = dict()
+			touched = self.availableTasks
+		else:
+			touched = [t for t in self.plan.touchedBy(changed) if t in self.matched]
+
+		for t in touched:
+			self.matched[t] = self.plan.matches(t, self.subject)
 
 	def _scheduleNonConflictingTasks(self):
-		possible_tasks = purge_impossible_tasks(self.subject, self.availableTasks)
-		doable_tasks = find_doable_tasks(self.subject, possible_tasks)
-		doable_tasks = purge_conflicting_tasks(doable_tasks)
+		self._updateMatches()
+		running_tasks = [t.__class__ for t in self.runningTasks]
+		possible_tasks, doable_tasks = self.plan.findDoableTasks(self.subject, self.availableTasks, self.matched, running_tasks)
 
 		if len(doable_tasks) > 0:
 			for t in doable_tasks:
+				del self.matched[t]
 				createdTask = t(self.subject)
 				self.runningTasks.append(createdTask)
 				self.taskQueue.addTask(createdTask, self.onDone)
 
 			self.task_path.append(doable_tasks)
-		else:
+		elif len(self.runningTasks) == 0:
 			log.debug("Final scheduling order became %s", self.task_path)
+			self.finished = True
 			self.callback(None, self.subject)
 
 		self.availableTasks = [t for t in possible_tasks if t not in doable_tasks]
 
 	def onDone(self, task, error, result):
-		if error:
-			self.callback(error, None)
-		else:
-			self.condition.acquire()
+		with self.condition:
+			if self.finished:
+				return
+
+			if isinstance(error, tasks.TaskSkipped):
+				log.warning("Skipped %s on %s: %s", task.__class__.__name__, self.subject[dc.identifier], error)
+			elif error:
+				self.finished = True
+				self.callback(error, None)
+				return
 
 			if task in self.runningTasks:
 				self.runningTasks.remove(task)
 
-			if len(self.runningTasks) == 0:
+			if self.dataflow or len(self.runningTasks) == 0:
 				self._scheduleNonConflictingTasks()
 
-			self.condition.release()
+class SubjectBatch(object):
+	"""
+	Feeds subjects lazily from an iterable to an engine, keeping at most
+	maxInFlight of them processed at once. callback is called with error and
+	subject as each subject finishes, and done, if given, once all have. Given
+	a journal, such as a stores.ScanJournal, completed subjects are recorded in
+	it and subjects it has already recorded are skipped.
+	"""
+	def __init__(self, engine, subjects, callback, maxInFlight, done = None, journal = None):
+		self.condition = threading.Condition()
+
+		self.engine = engine
+		self.subjects = iter(subjects)
+		self.callback = callback
+		self.maxInFlight = maxInFlight
+		self.done = done
+		self.journal = journal
+
+		self.inFlight = 0
+		self.exhausted = False
+		self.finished = False
+		self.pumping = False # Only one thread at a time pulls from subjects
+
+		self._pump()
+
+	def _pump(self):
+		with self.condition:
+			if self.pumping:
+				return
+			self.pumping = True
+
+		while True:
+			with self.condition:
+				if self.exhausted or self.inFlight >= self.maxInFlight:
+					self.pumping = False
+					finished = self.exhausted and self.inFlight == 0 and not self.finished
+					self.finished = self.finished or finished
+					break
+
+				self.inFlight += 1
+
+			try:
+				subject = next(self.subjects)
+			except Exception as e:
+				if not isinstance(e, StopIteration):
+					log.exception("Failed to get next subject, ending batch: %s" % e)
+				with self.condition:
+					self.inFlight -= 1
+					self.exhausted = True
+				continue
+
+			if self.journal != None and self.journal.isCompleted(subject[dc.identifier]):
+				with self.condition:
+					self.inFlight -= 1
+				continue
+
+			try:
+				self.engine.get(subject, self.onSubjectDone)
+			except Exception as e:
+				log.exception("Failed to process subject: %s" % e)
+				try:
+					self.onSubjectDone(e, subject)
+				except Exception as e:
+					log.exception("Failure in callback: %s" % e)
+
+		if finished:
+			if self.journal != None:
+				self.journal.finish()
+			if self.done:
+				self.done()
+
+	def onSubjectDone(self, error, subject):
+		try:
+			if error == None and self.journal != None:
+				try:
+					self.journal.record(subject[dc.identifier], subject)
+				except Exception as e:
+					log.exception("Failed to journal subject: %s" % e)
+
+			self.callback(error, subject)
+		finally:
+			# A raising callback must not stall the batch
+			with self.condition:
+				self.inFlight -= 1
+
+			self._pump()
 
 class Engine(object):
-	def __init__(self, threadPool):
+	"""
+	Processes subjects with the tasks of registered modules. Given a store,
+	such as a stores.ResultStore, subjects of unchanged files are answered
+	from it and all other subjects are kept in it once processed. Processed
+	subjects are also written to every sink added with addSink.
+	"""
+	def __init__(self, threadPool, dataflow = False, cpuPool = None, memoizeDuration = 60.0, store = None):
 		self.registeredTasks = list()
 		self.threadPool = threadPool
+		self.cpuPool = cpuPool
+		self.taskRegistry = taskqueues.TaskRegistry(threadPool, memoizeDuration)
+		self.dataflow = dataflow
+		self.conflicts = ConflictMatrix()
+		self.plan = SchedulingPlan(self.registeredTasks, self.conflicts)
+		self.store = store
+		self.sinks = list()
 
 	def registerModule(self, module):
 		self.registeredTasks.extend([t for t in module if issubclass(t, tasks.SubjectTask)])
+		self.plan = SchedulingPlan(self.registeredTasks, self.conflicts)
+
+	def addSink(self, sink):
+		"""
+		Writes every subject processed from now on to sink, such as a
+		sinks.JsonLinesSink, before its callback is called.
+		"""
+		self.sinks.append(sink)
 
 	def get(self, subject, callback):
-		std = SubjectTaskDispatcher(subject, self.registeredTasks, taskqueues.TaskQueue(self.threadPool), callback)
+		if len(self.sinks) > 0:
+			callback = self._sinking(callback)
+
+		if self.store != None:
+			self.threadPool.append(self._getStored, threadpools.ignore, 0, subject, callback)
+			return None
+
+		return self._dispatch(subject, callback)
+
+	def _getStored(self, subject, callback):
+		uri = subject[dc.identifier]
+		identity = self.store.identify(uri) if uri else None
+
+		try:
+			stored = self.store.get(uri, identity)
+		except Exception as e:
+			log.exception("Failed to read stored subject: %s" % e)
+			stored = None
+
+		if stored != None:
+			log.debug("Unchanged %s" % uri)
+			callback(None, stored)
+			return
+
+		def c(error, subject):
+			if error == None and identity != None:
+				try:
+					self.store.put(uri, identity, subject)
+				except Exception as e:
+					log.exception("Failed to store subject: %s" % e)
+
+			callback(error, subject)
+
+		# Run on the threadpool where nobody sees what is raised
+		try:
+			self._dispatch(subject, c)
+		except Exception as e:
+			log.exception("Failed to dispatch %s" % uri)
+			callback(e, None)
+
+	def _sinking(self, callback):
+		def c(error, subject):
+			if error == None:
+				for sink in self.sinks:
+					try:
+						sink.write(subject)
+					except Exception as e:
+						log.exception("Failed to write subject to %s: %s" % (sink, e))
+
+			callback(error, subject)
+
+		return c
+
+	def _dispatch(self, subject, callback):
+		std = SubjectTaskDispatcher(subject, self.plan, taskqueues.TaskQueue(self.threadPool, self.cpuPool, self.taskRegistry), callback, self.dataflow)
 		return std # TODO Should not return, should just keep a reference so it can be paused
+
+	def submit(self, subject):
+		"""
+		Processes subject and returns a concurrent.futures.Future which gets
+		the subject as result, or the error as exception.
+		"""
+		if Future == None:
+			raise ImportError("Engine.submit requires concurrent.futures, install the futures package")
+
+		future = Future()
+		future.set_running_or_notify_cancel()
+
+		def c(error, subject):
+			if error:
+				future.set_exception(error)
+			else:
+				future.set_result(subject)
+
+		self.get(subject, c)
+		return future
+
+	def submitAsync(self, subject, loop = None):
+		"""
+		Processes subject and returns an asyncio future for it, awaitable on
+		loop (default the current event loop) while tasks run on the engines
+		pools.
+		"""
+		if asyncio == None:
+			raise ImportError("Engine.submitAsync requires asyncio or trollius")
+
+		return asyncio.wrap_future(self.submit(subject), loop=loop)
+
+	def getMany(self, subjects, callback, maxInFlight = 64, done = None, journal = None):
+		"""
+		Processes subjects pulled lazily from an iterable, with at most
+		maxInFlight of them in the engine at once. callback is called as in get
+		for every subject and done, if given, once all are processed. Given a
+		journal the batch can be resumed if interrupted, see SubjectBatch.
+		"""
+		return SubjectBatch(self, subjects, callback, maxInFlight, done, journal)
@@ -1,6 +1,7 @@
 import types
 import re
-from utils import Enum
+from utils import Enum, extends_class
+from predicates import intern_predicate
 
 match = Enum([ "NEVER", "NO", "YES" ])
 
@@ -32,10 +33,13 @@ class predicateObjectDemand(demand):
         if not (isinstance(self.object, types.StringTypes) or self.object == None):
             raise ValueError("Object must be string type or None")
 
+        self.pattern = re.compile(self.object) if self.object else None
+        self.predicateId = intern_predicate(self.predicate)
+
     def matches(self, subject):
-        obj = subject[self.predicate]
-        if obj and self.object:
-            return re.search(self.object, obj) != None
+        obj = subject.lookup(self.predicateId)
+        if obj and self.pattern:
+            return self.pattern.search(obj) != None
         else:
             return obj != None
 
@@ -80,9 +84,9 @@ class requiredClass(demand):
     def matches(self, subject):
         if self.Class == subject.Class: # Input and sought class are same
             return True
-        elif re.match(subject.Class, self.Class): # Input class may extend towards sought class, but it has not reached there yet.
+        elif extends_class(self.Class, subject.Class): # Input class may extend towards sought class, but it has not reached there yet.
             return False
-        elif re.match(self.Class, subject.Class): # Input class is extended version of sought class
+        elif extends_class(subject.Class, self.Class): # Input class is extended version of sought class
             return True if self.allowExtended else match.NEVER
         else: # Input class will never reach sought class, diamond problem
             return match.NEVER
@@ -0,0 +1,146 @@
+import tasks
+
+import random
+import threading
+import time
+import urlparse
+
+import logging
+log = logging.getLogger("heimdall.hosts")
+
+class HostLimit(object):
+    """
+    Limits requests to a host, to at most rate per second in bursts of up to
+    burst requests, and to at most concurrency requests at once. A limit of
+    None is unbounded.
+    """
+
+    # Seconds to wait before trying again when all concurrent slots are taken
+    concurrencyPoll = 0.1
+
+    def __init__(self, rate = None, burst = 1, concurrency = None):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.concurrency = concurrency
+
+        self.lock = threading.Lock()
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+        self.running = 0
+
+    def acquire(self):
+        """
+        Takes a slot for a request and returns 0, or if the host is busy the
+        number of seconds to wait before trying again. A taken slot must be
+        given back with release.
+        """
+        with self.lock:
+            if self.concurrency != None and self.running >= self.concurrency:
+                return self.concurrencyPoll
+
+            if self.rate != None:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens < 1:
+                    return (1 - self.tokens) / self.rate
+
+                self.tokens -= 1
+
+            self.running += 1
+            return 0
+
+    def release(self):
+        with self.lock:
+            self.running -= 1
+
+class HostUnavailable(tasks.TaskSkipped):
+    """
+    A host is failing, tasks depending on it are skipped.
+    """
+    pass
+
+class CircuitBreaker(object):
+    """
+    Opens after threshold failures in a row to a host, requests are then
+    failed fast for cooldown seconds. After the cooldown a single request is
+    let through, closing the breaker if it succeeds or opening it again.
+    """
+    def __init__(self, threshold = 5, cooldown = 60.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.openUntil = None
+        self.probing = False
+
+    def allow(self):
+        with self.lock:
+            if self.openUntil == None:
+                return True
+            elif self.openUntil <= time.time() and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.openUntil = None
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                if self.openUntil == None or self.probing:
+                    log.warning("Circuit opened for %s seconds after %s failures", self.cooldown, self.failures)
+                self.openUntil = time.time() + self.cooldown
+                self.probing = False
+
+# Retries of failed requests, waiting backoffBase * 2 ^ attempt seconds with
+# full jitter, but at most backoffMax
+maxRetries = 3
+backoffBase = 0.5
+backoffMax = 30.0
+
+def backoff(attempt):
+    return random.uniform(0, min(backoffMax, backoffBase * 2 ** attempt))
+
+def retryable(error):
+    """
+    Network errors, server errors and too many requests are worth retrying.
+    """
+    status = getattr(error, "status", None)
+    return isinstance(error, IOError) and (status == None or status == 429 or status >= 500)
+
+limits = dict() # Host -> HostLimit
+breakers = dict() # Host -> CircuitBreaker
+
+def limit_host(host, rate = None, burst = 1, concurrency = None):
+    """
+    Limits the requests to host, see HostLimit.
+    """
+    limits[host.lower()] = HostLimit(rate, burst, concurrency)
+
+def limit_for(uri):
+    """
+    Returns the HostLimit for the host of uri or None if not limited.
+    """
+    host = urlparse.urlparse(uri).hostname
+    return limits.get(host, None) if host else None
+
+def breaker_for(uri):
+    """
+    Returns the CircuitBreaker for the host of uri, or None if uri has no host.
+    """
+    host = urlparse.urlparse(uri).hostname
+    if not host:
+        return None
+
+    breaker = breakers.get(host, None)
+    if breaker == None:
+        breaker = breakers.setdefault(host, CircuitBreaker())
+    return breaker
@@ -1,11 +1,34 @@
 from collections import namedtuple
+import threading
+
+# Every predicate seen is given a small integer id, its index in predicateUris
+predicateIds = dict()
+predicateUris = list()
+predicateLock = threading.Lock()
+
+def intern_predicate(uri):
+    """
+    Returns the id of predicate uri, giving it the next free one if new.
+    """
+    pid = predicateIds.get(uri)
+    if pid == None:
+        with predicateLock:
+            pid = predicateIds.get(uri)
+            if pid == None:
+                pid = len(predicateUris)
+                predicateUris.append(intern(uri) if isinstance(uri, str) else uri)
+                predicateIds[uri] = pid
+
+    return pid
 
 def PredicateBuilder(short, namespace, properties):
     predicate = namedtuple(short, properties + [ "xmlns" ])
     predicate.xmlns = namespace
 
     for prop in properties:
-        setattr(predicate, prop, namespace + prop)
+        uri = namespace + prop
+        intern_predicate(uri)
+        setattr(predicate, prop, predicateUris[predicateIds[uri]])
 
     return predicate
 
@@ -1,22 +1,110 @@
 import tasks
+import caches
+import hosts
 
 import os
 import datetime
-import hashlib
-import urlparse
+import functools
+import time
 import tempfile
+import urllib
+import urlparse
 
 import logging
 log = logging.getLogger("heimdall.resources")
 
+# Timeouts in seconds for HTTP requests, see configure_http
+connectTimeout = 10
+readTimeout = 30
+
 try:
     import requests
-    def vfs_read(uri):
-        return requests.get(uri).content
-except:
-    import urllib
-    def vfs_read(uri):
-        return urllib.urlopen(uri).read()
+    import requests.adapters
+
+    # Shared session, keeping connections alive in per host pools
+    session = requests.Session()
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+
+    def configure_http(poolSize = 10, connect = None, read = None):
+        """
+        Sizes the per host connection pools, should be at least the number of
+        threads fetching resources, and sets timeouts if given.
+        """
+        global connectTimeout, readTimeout
+        connectTimeout = connect if connect != None else connectTimeout
+        readTimeout = read if read != None else readTimeout
+
+        adapter = requests.adapters.HTTPAdapter(pool_connections=poolSize, pool_maxsize=poolSize)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+
+    def http_get(uri, headers = None):
+        """
+        Returns status, headers with lowercase names and body of a GET on uri.
+        """
+        response = session.get(uri, headers=headers, timeout=(connectTimeout, readTimeout))
+        return response.status_code, dict((k.lower(), v) for k, v in response.headers.items()), response.content
+except ImportError:
+    import urllib2
+    import gzip
+    import StringIO
+
+    def configure_http(poolSize = 10, connect = None, read = None):
+        """
+        Sets timeouts if given, urllib2 has neither connection pools nor
+        separate connect timeouts so the longest is used.
+        """
+        global connectTimeout, readTimeout
+        connectTimeout = connect if connect != None else connectTimeout
+        readTimeout = read if read != None else readTimeout
+
+    def http_get(uri, headers = None):
+        """
+        Returns status, headers with lowercase names and body of a GET on uri.
+        """
+        request = urllib2.Request(uri, headers=headers or {})
+        request.add_header("Accept-Encoding", "gzip")
+
+        try:
+            response = urllib2.urlopen(request, timeout=max(connectTimeout, readTimeout))
+        except urllib2.HTTPError as e:
+            response = e
+
+        responseHeaders = dict((k.lower(), v) for k, v in response.info().items())
+        body = response.read()
+        if responseHeaders.get("content-encoding") == "gzip":
+            body = gzip.GzipFile(fileobj=StringIO.StringIO(body)).read()
+
+        return response.code, responseHeaders, body
+
+class HTTPError(IOError):
+    """
+    A resource was answered with an error status.
+    """
+    def __init__(self, uri, status):
+        super(HTTPError, self).__init__("HTTP status {0} for {1}".format(status, uri))
+        self.status = status
+
+def vfs_fetch(uri, headers = None):
+    """
+    Returns status, headers with lowercase names and body of uri. Request
+    headers are only sent for http(s), other schemes always answer 200.
+    """
+    if urlparse.urlparse(uri).scheme in ("http", "https"):
+        status, responseHeaders, body = http_get(uri, headers)
+        if status >= 400:
+            raise HTTPError(uri, status)
+        return status, responseHeaders, body
+    return 200, {}, urllib.urlopen(uri).read()
+
+def vfs_read(uri):
+    return vfs_fetch(uri)[2]
+
+# Process wide cache of resources read by SimpleResource
+memoryCache = caches.MemoryCache()
+
+# Cache of resources read by CachedSimpleResource, shared between processes
+diskCache = caches.DiskCache(os.path.join(tempfile.gettempdir(), "heimdall", "cache.db"))
 
 class Resource(tasks.Task):
     """
@@ -26,87 +114,214 @@ class Resource(tasks.Task):
     def __init__(self, uri):
         self.uri = uri
 
+    def key(self):
+        return (self.__class__, self.uri)
+
     def run(self):
         return self
 
     def read(self):
         return vfs_read(self.uri)
 
+    def fetch(self, headers = None):
+        return vfs_fetch(self.uri, headers)
+
 class SimpleResource(tasks.Task):
     """
     Simpler resource access, when acquired as requirement it will give the entire
     resource as result. This is useful when a resource is needed in its entirety
     to process. Examples of can be text files such as xml, json etc. The resource
-    is not parsed and its binary form is read.
+    is not parsed and its binary form is read. Resources read are kept in
+    memoryCache for ttl seconds, the caches default if None. Reads respect the
+    HostLimit of the resources host, waiting for it without holding a worker.
+    Failed reads are retried with backoff, when retries are exhausted or the
+    hosts circuit breaker is open hosts.HostUnavailable is raised.
     """
-    def __init__(self, uri):
+    def __init__(self, uri, ttl = None):
         self.uri = uri
+        self.ttl = ttl
+
+    def key(self):
+        return (self.__class__, self.uri)
+
+    def preFlight(self):
+        self.cached = memoryCache.get(self.uri)
+        if self.cached != None:
+            return tasks.deferedrun(self.runCached, None)
+
+        return super(SimpleResource, self).preFlight()
 
     def require(self):
         return Resource(self.uri)
 
-    def run(self, resource):
+    def runCached(self):
+        return self.cached
+
+    def run(self, resource, attempt = 0):
+        # Take the host slot before asking the breaker, a probe it lets
+        # through must be run and not deferred
+        limit = hosts.limit_for(self.uri)
+        if limit:
+            wait = limit.acquire()
+            if wait > 0:
+                return tasks.deferedrun(functools.partial(self.run, resource, attempt), None, wait)
+
+        breaker = hosts.breaker_for(self.uri)
+        if breaker and not breaker.allow():
+            if limit:
+                limit.release()
+            raise hosts.HostUnavailable("Circuit open for {0}".format(self.uri))
+
+        try:
+            result = self.fetch(resource)
+        except Exception as e:
+            if not hosts.retryable(e):
+                if breaker:
+                    breaker.success() # The host answered
+                raise
+
+            if breaker:
+                breaker.failure()
+
+            if attempt < hosts.maxRetries:
+                log.debug("Retrying %s after %s" % (self.uri, e))
+                return tasks.deferedrun(functools.partial(self.run, resource, attempt + 1), None, hosts.backoff(attempt))
+
+            raise hosts.HostUnavailable("Failed reading {0} {1} times: {2}".format(self.uri, attempt + 1, e))
+        finally:
+            if limit:
+                limit.release()
+
+        if breaker:
+            breaker.success()
+
+        memoryCache.put(self.uri, result, self.ttl)
+        return result
+
+    def fetch(self, resource):
         return resource.read()
 
 class CachedSimpleResource(SimpleResource):
     """
     Adds a caching layer on top of SimpleResource. duration is a timedelta or
     number of seconds for which the cache is valid (default: one week). Setting
-    invalidateCache to True re-caches immediately.
+    invalidateCache to True re-caches immediately. The memory cache is
+    consulted first, then diskCache, both keyed on the URI. Expired entries
+    served with an ETag or Last-Modified are revalidated with a conditional
+    request, on 304 Not Modified the cached body is kept for another duration.
     """
     def __init__(self, uri, duration=datetime.timedelta(weeks=1), invalidateCache=False):
-        self.needsCaching = invalidateCache or self.isExpired(uri)
-        if self.needsCaching:
-            self.uri = uri
-        else:
-            self.uri = self.getCachedURI(uri)
+        super(CachedSimpleResource, self).__init__(uri)
+        self.invalidateCache = invalidateCache
 
-        self.expires = None # When does the current request expire?
         if isinstance(duration, datetime.timedelta):
-            self.expires = datetime.datetime.now() + duration
-        elif duration > 0:
-            self.expires = datetime.datetime.now() + datetime.timedelta(seconds=duration)
-
-    def run(self, resource):
-        result = super(CachedSimpleResource, self).run(resource)
-        if self.needsCaching:
-            try:
-                log.debug("Caching resource %s to %s" % (self.uri, self.getCachedURI(self.uri)))
-                # Create the cache folder if it doesn't exist
-                if not os.path.exists(os.path.join(tempfile.gettempdir(), "heimdall")):
-                    os.makedirs(os.path.join(tempfile.gettempdir(), "heimdall"))
-                open(self.getCachedURI(self.uri), "wb").write(result)
-                if self.expires:
-                    # Our serialization format "YYYY-MM-DD HH:MM:SS" mirrors isoformat(' ') with no microseconds
-                    open(self.getCachedURI(self.uri) + ".expires", "w").write(self.expires.strftime("%Y-%m-%d %H:%M:%S"))
-                elif os.path.exists(self.getCachedURI(self.uri) + ".expires"):
-                    # If there's no expiration, make sure old .expires files are removed
-                    os.remove(self.getCachedURI(self.uri) + ".expires")
-            except Exception as e:
-                log.exception("Failed to cache resource: %s" % e)
-        return result
+            duration = duration.total_seconds()
+
+        self.expires = None # When does the current request expire?
+        if duration > 0:
+            self.expires = time.time() + duration
+            self.ttl = duration
 
-    def getCachedURI(self, uri):
-        # The URI of the resource is invariant and derivations shouldn't be re-calculated.
+    def key(self):
+        # Invalidating reads must not be answered by a shared cached read
+        if self.invalidateCache:
+            return None
+        return super(CachedSimpleResource, self).key()
+
+    def preFlight(self):
+        # Runs under the task queue lock, only the memory cache is checked
+        # here and the disk cache is left to lookup on the threadpool
+        self.cached = None
+        self.stale = None # Expired disk cache entry to revalidate
+        self.validators = (None, None)
+        self.revalidated = False
+
+        if self.invalidateCache:
+            memoryCache.invalidate(self.uri)
+            return tasks.deferedrun(self.run, self.require())
+
+        self.cached = memoryCache.get(self.uri)
+        if self.cached != None:
+            return tasks.deferedrun(self.runCached, None)
+
+        return tasks.deferedrun(self.lookup, None)
+
+    def lookup(self):
+        """
+        Returns the resource from the disk cache if valid, otherwise defers to
+        reading it.
+        """
         try:
-            return self.cachedURI
-        except:
-            self.cachedURI = os.path.join(tempfile.gettempdir(), "heimdall", hashlib.md5(uri).hexdigest())
-            # Cast to URI for vfs_read()
-            self.cachedURI = urlparse.urlparse(self.cachedURI).path
-            return self.cachedURI
-
-    def isExpired(self, uri):
-        # The presence of a .expires file indicates an expiration time
-        if os.path.exists(self.getCachedURI(uri) + ".expires"):
-            try:
-                timestring = open(self.getCachedURI(uri) + ".expires").read()
-                # Deserialize YYYY-MM-DD HH:MM:SS
-                timeobject = datetime.datetime.strptime(timestring, "%Y-%m-%d %H:%M:%S")
-                return timeobject <= datetime.datetime.now()
-            except ValueError as e:
-                log.error("\"%s\" can't be parsed by strptime(): %s" % (timestring, e))
-            except Exception as e:
-                log.error(e)
-        # If the resource itself doesn't exist, consider it expired
-        return not os.path.exists(self.getCachedURI(uri))
+            entry = diskCache.lookup(self.uri)
+        except Exception as e:
+            log.exception("Failed to read cached resource: %s" % e)
+            entry = None
+
+        if entry and (entry[1] == None or entry[1] > time.time()):
+            self.cached = entry[0]
+            memoryCache.put(self.uri, self.cached, entry[1] - time.time() if entry[1] else None)
+            return self.cached
+
+        if entry and (entry[2] or entry[3]):
+            self.stale = entry
+
+        return tasks.deferedrun(self.run, self.require())
+
+    def fetch(self, resource):
+        headers = {}
+        if self.stale:
+            if self.stale[2]:
+                headers["If-None-Match"] = self.stale[2]
+            if self.stale[3]:
+                headers["If-Modified-Since"] = self.stale[3]
+
+        status, responseHeaders, body = resource.fetch(headers)
+        self.validators = (responseHeaders.get("etag"), responseHeaders.get("last-modified"))
+
+        if status == 304 and self.stale:
+            log.debug("Revalidated resource %s" % self.uri)
+            self.revalidated = True
+            return self.stale[0]
+
+        self.revalidated = False
+        return body
+
+    def run(self, resource, attempt = 0):
+        result = super(CachedSimpleResource, self).run(resource, attempt)
+        if isinstance(result, tasks.deferedrun):
+            return result
+
+        try:
+            if self.revalidated:
+                diskCache.touch(self.uri, self.expires, *self.validators)
+            else:
+                log.debug("Caching resource %s" % self.uri)
+                diskCache.put(self.uri, result, self.expires, *self.validators)
+        except Exception as e:
+            log.exception("Failed to cache resource: %s" % e)
+        return result
+
+class SearchResource(CachedSimpleResource):
+    """
+    A CachedSimpleResource for search queries, isEmpty is called with the
+    result and should return True if nothing was found. Empty results are
+    cached for negativeDuration instead of duration, so queries that never
+    match are not repeated on every scan but are retried sooner than matches.
+    """
+    def __init__(self, uri, isEmpty, duration=datetime.timedelta(weeks=1), negativeDuration=datetime.timedelta(days=1), invalidateCache=False):
+        super(SearchResource, self).__init__(uri, duration, invalidateCache)
+        self.isEmpty = isEmpty
+
+        if isinstance(negativeDuration, datetime.timedelta):
+            negativeDuration = negativeDuration.total_seconds()
+        self.negativeDuration = negativeDuration
+
+    def fetch(self, resource):
+        result = super(SearchResource, self).fetch(resource)
+
+        if self.negativeDuration > 0 and self.isEmpty(result):
+            log.debug("No results for %s" % self.uri)
+            self.expires = time.time() + self.negativeDuration
+            self.ttl = self.negativeDuration
+
+        return result
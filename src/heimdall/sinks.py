@@ -0,0 +1,91 @@
+import json
+import os
+import threading
+import time
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+import logging
+log = logging.getLogger("heimdall.sinks")
+
+class Sink(object):
+    """
+    Writes processed subjects to out, a path or file object, as they complete
+    so they need not be kept around. Encoded subjects are written batchSize at
+    a time and the file is synced to disk at most every syncInterval seconds,
+    or never if None. Subclasses implement encode.
+    """
+    def __init__(self, out, batchSize = 100, syncInterval = 1.0):
+        self.out = open(out, "ab") if isinstance(out, basestring) else out
+        self.ownsOut = isinstance(out, basestring)
+        self.batchSize = batchSize
+        self.syncInterval = syncInterval
+
+        self.lock = threading.Lock()
+        self.batch = list()
+        self.lastSync = time.time()
+
+    def encode(self, subject):
+        """
+        Returns subject encoded as a string.
+        """
+        raise NotImplementedError()
+
+    def record(self, subject):
+        return { "Class": subject.Class, "metadata": subject.to_dict() }
+
+    def write(self, subject):
+        data = self.encode(subject)
+
+        with self.lock:
+            self.batch.append(data)
+            if len(self.batch) >= self.batchSize:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if len(self.batch) > 0:
+            self.out.write("".join(self.batch))
+            self.batch = list()
+        self.out.flush()
+
+        now = time.time()
+        if self.syncInterval != None and now - self.lastSync >= self.syncInterval:
+            try:
+                os.fsync(self.out.fileno())
+            except (AttributeError, OSError, IOError):
+                pass # Pipes and in-memory files cannot be synced
+            self.lastSync = now
+
+    def close(self):
+        with self.lock:
+            self.lastSync = 0 # Sync whatever is left
+            self._flush()
+            if self.ownsOut:
+                self.out.close()
+
+class JsonLinesSink(Sink):
+    """
+    Writes every subject as a line of compact JSON.
+    """
+    def encode(self, subject):
+        return json.dumps(self.record(subject), sort_keys=True, separators=(",", ":")) + "\n"
+
+class MsgpackSink(Sink):
+    """
+    Writes every subject as a msgpack map, requires the msgpack package.
+    """
+    def __init__(self, out, batchSize = 100, syncInterval = 1.0):
+        if msgpack == None:
+            raise ImportError("MsgpackSink requires msgpack, install the msgpack package")
+
+        super(MsgpackSink, self).__init__(out, batchSize, syncInterval)
+
+    def encode(self, subject):
+        return msgpack.packb(self.record(subject))
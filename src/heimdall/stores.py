@@ -0,0 +1,225 @@
+from core import Subject
+from predicates import dc
+from utils import thread_connection
+
+import json
+import os
+import threading
+import time
+import urllib
+import urlparse
+
+import logging
+log = logging.getLogger("heimdall.stores")
+
+def local_path(uri):
+    """
+    Returns the local file system path of a file uri or plain path, None for
+    other schemes.
+    """
+    parsed = urlparse.urlparse(uri)
+    if parsed.scheme == "file":
+        return urllib.unquote(parsed.netloc + parsed.path)
+    elif parsed.scheme == "":
+        return uri
+    return None
+
+def file_uri(path):
+    """
+    Returns the file uri of the local path, made absolute and quoted so it
+    reads back with local_path.
+    """
+    return "file://" + urllib.pathname2url(os.path.abspath(path))
+
+def identify(uri):
+    """
+    Returns the identity of a local file as a tuple of size, mtime and inode,
+    or None if uri is not a readable local file.
+    """
+    path = local_path(uri)
+    if path == None:
+        return None
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    return st.st_size, st.st_mtime, st.st_ino
+
+class ResultStore(object):
+    """
+    Persistent store of processed subjects keyed on their uri, stored in a
+    single sqlite database at path which is safe to share between threads and
+    processes. Every subject is kept with the identity of the file it was
+    processed from and is only returned while the file still has it, so a
+    changed file is processed again.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    def _connection(self):
+        return thread_connection(self.local, self.path, """
+            CREATE TABLE IF NOT EXISTS subjects (uri TEXT PRIMARY KEY, size INTEGER, mtime REAL, inode INTEGER, class TEXT, metadata TEXT, stored REAL);
+        """)
+
+    def identify(self, uri):
+        return identify(uri)
+
+    def get(self, uri, identity):
+        """
+        Returns the subject stored for uri if it was processed from a file with
+        the same identity, otherwise None.
+        """
+        if identity == None:
+            return None
+
+        row = self._connection().execute("SELECT size, mtime, inode, class, metadata FROM subjects WHERE uri = ?", (uri, )).fetchone()
+        if row == None or tuple(row[:3]) != tuple(identity):
+            return None
+
+        return self._subject(row[3], row[4])
+
+    def put(self, uri, identity, subject):
+        """
+        Stores subject as the result of processing uri with identity.
+        """
+        if identity == None:
+            return
+
+        s = json.dumps(subject.to_dict(), sort_keys=True, separators=(",", ":"))
+        connection = self._connection()
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO subjects (uri, size, mtime, inode, class, metadata, stored) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (uri, identity[0], identity[1], identity[2], subject.Class, s, time.time()))
+
+    def move(self, uri, newUri):
+        """
+        Moves what is stored for uri, or for every uri below it if a folder, to
+        newUri keeping the file identities. Returns the moved uris as pairs of
+        old and new uri.
+        """
+        moved = list()
+        connection = self._connection()
+        with connection:
+            for oldUri, metadata in self._below(connection, uri, "uri, metadata"):
+                movedUri = newUri + oldUri[len(uri):]
+
+                s = json.loads(metadata)
+                s[dc.identifier] = movedUri
+                connection.execute("DELETE FROM subjects WHERE uri = ?", (movedUri, ))
+                connection.execute("UPDATE subjects SET uri = ?, metadata = ? WHERE uri = ?",
+                    (movedUri, json.dumps(s, sort_keys=True, separators=(",", ":")), oldUri))
+
+                moved.append((oldUri, movedUri))
+
+        return moved
+
+    def remove(self, uri):
+        """
+        Removes what is stored for uri, or for every uri below it if a folder.
+        Returns the removed uris.
+        """
+        connection = self._connection()
+        with connection:
+            removed = [row[0] for row in self._below(connection, uri, "uri")]
+            connection.executemany("DELETE FROM subjects WHERE uri = ?", [(r, ) for r in removed])
+
+        return removed
+
+    def _below(self, connection, uri, columns):
+        prefix = uri.rstrip("/") + "/"
+        return connection.execute("SELECT {0} FROM subjects WHERE uri = ? OR substr(uri, 1, ?) = ?".format(columns),
+            (uri, len(prefix), prefix)).fetchall()
+
+    def _subject(self, Class, metadata):
+        subject = Subject(Class)
+        for predicate, value in json.loads(metadata).items():
+            for v in (value if isinstance(value, list) else [value]):
+                subject.emit(predicate, v)
+
+        subject.popChanges()
+        return subject
+
+class ScanJournal(object):
+    """
+    Append only journal at path of the subjects completed by a scan, used to
+    resume an interrupted scan without processing them again. Every subject is
+    written as a line of JSON as it completes and the file is synced to disk
+    at most every syncInterval seconds. Once the scan completes, finish
+    removes the journal so the next scan starts over.
+    """
+    def __init__(self, path, syncInterval = 1.0):
+        self.path = path
+        self.syncInterval = syncInterval
+
+        self.lock = threading.Lock()
+        self.file = None
+        self.lastSync = 0
+        self.completed = self._load()
+
+    def _load(self):
+        completed = set()
+        try:
+            f = open(self.path)
+        except IOError:
+            return completed
+
+        with f:
+            for line in f:
+                try:
+                    completed.add(json.loads(line)["uri"])
+                except (ValueError, KeyError):
+                    pass # Last line torn by a crash
+
+        if len(completed) > 0:
+            log.info("Resuming scan, %d subjects already completed" % len(completed))
+        return completed
+
+    def isCompleted(self, uri):
+        return uri in self.completed
+
+    def record(self, uri, subject):
+        line = json.dumps({ "uri": uri, "Class": subject.Class, "metadata": subject.to_dict() }, sort_keys=True, separators=(",", ":")) + "\n"
+
+        with self.lock:
+            if self.file == None:
+                self._open()
+
+            self.file.write(line)
+            self.file.flush()
+
+            now = time.time()
+            if now - self.lastSync >= self.syncInterval:
+                os.fsync(self.file.fileno())
+                self.lastSync = now
+
+    def _open(self):
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self.file = open(self.path, "a+")
+        self.file.seek(0, os.SEEK_END)
+        if self.file.tell() > 0:
+            self.file.seek(-1, os.SEEK_END)
+            if self.file.read(1) != "\n":
+                self.file.seek(0, os.SEEK_END)
+                self.file.write("\n") # Do not continue a torn line
+
+    def close(self):
+        with self.lock:
+            if self.file != None:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+                self.file = None
+
+    def finish(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        self.completed = set()
@@ -5,7 +5,12 @@ class supply(object):
     """
     Base class for what a task may supply
     """
-    pass
+
+    def matches(self, demand):
+        return False
+
+    def conflict(self, supply):
+        return False
 
 class predicateObjectSupply(supply):
     """
@@ -1,8 +1,10 @@
 import tasks
+import threadpools
 
 from collections import deque
 from collections import namedtuple
 import threading
+import time
 import types
 
 class NotFilled(object):
@@ -23,33 +25,136 @@ class TaskData(object):
         self.requirementsMap = dict()
         self.requirements = list()
         self.runnable = None
+        self.delay = 0
+
+class TaskRegistry(object):
+    """
+    A registry of keyed tasks shared by the task queues of an engine. While a
+    task with a key is running, tasks with the same key wait for its result
+    instead of running themselves, a result is also memoized for
+    memoizeDuration seconds. Waiters are called from the threadpool so that
+    no task queue lock is held while calling into another queue.
+    """
+    def __init__(self, threadPool, memoizeDuration = 60.0):
+        self.threadPool = threadPool
+        self.memoizeDuration = memoizeDuration
+
+        self.condition = threading.Condition()
+        self.inFlight = dict() # Key -> waiters for running task
+        self.memo = dict() # Key -> (expires, result)
+        self.expiryOrder = deque() # (expires, key) in order of memoization
+
+    def join(self, key, waiter):
+        """
+        Returns True if the caller should run the task with key, and then call
+        complete. Otherwise waiter will be called with error and result.
+        """
+        with self.condition:
+            entry = self.memo.get(key, None)
+            if entry and entry[0] > time.time():
+                self.threadPool.append(waiter, threadpools.ignore, 0, None, entry[1])
+                return False
+            elif key in self.inFlight:
+                self.inFlight[key].append(waiter)
+                return False
+            else:
+                self.inFlight[key] = list()
+                return True
+
+    def complete(self, key, error, result):
+        with self.condition:
+            waiters = self.inFlight.pop(key, [])
+
+            now = time.time()
+            while len(self.expiryOrder) > 0 and self.expiryOrder[0][0] <= now:
+                expires, expiredKey = self.expiryOrder.popleft()
+                if self.memo.get(expiredKey, (None, ))[0] == expires:
+                    del self.memo[expiredKey]
+
+            if not error and self.memoizeDuration > 0:
+                expires = now + self.memoizeDuration
+                self.memo[key] = (expires, result)
+                self.expiryOrder.append((expires, key))
+
+            for waiter in waiters:
+                self.threadPool.append(waiter, threadpools.ignore, 0, error, result)
 
 class TaskQueue(object):
     """
     A queue which will manage tasks, will schedule out them on the threadpool.
-    The queue will also manage any requirements of given tasks.
+    The queue will also manage any requirements of given tasks. Runnables of
+    tasks with a "cpu" executionClass are scheduled on cpuPool if given. Tasks
+    with a key are shared through taskRegistry if given.
     """
 
-    def __init__(self, threadPool):
+    def __init__(self, threadPool, cpuPool = None, taskRegistry = None):
         self.threadPool = threadPool
+        self.cpuPool = cpuPool
+        self.taskRegistry = taskRegistry
 
         self.condition = threading.Condition()
         self.runnableOwnerMap = dict()
         self.taskDataMap = dict()
         self.requirementOwnerMap = dict()
 
+    def _poolFor(self, task):
+        """
+        Returns the pool which should run the runnables of task.
+        Internal use only.
+        """
+        if self.cpuPool and task.executionClass == "cpu":
+            return self.cpuPool
+        return self.threadPool
+
     def addTask(self, task, callback):
         """
         Method to add a task to the queue. When it has run the result or error
         will be sent to the callback method.
         """
+        key = task.key() if self.taskRegistry else None
+
+        if key != None:
+            def waiter(error, result):
+                callback(task, error, result)
+
+            if not self.taskRegistry.join(key, waiter):
+                return
+
+            callback = self._sharedCallback(key, callback)
+
         with self.condition:
             self.taskDataMap[task] = TaskData(task, callback)
 
             rr = task.preFlight()
-            self._addRunnable(task, rr.runnable, rr.requirements)
+            self._addRunnable(task, rr.runnable, rr.requirements, rr.delay)
+
+    def _sharedCallback(self, key, callback):
+        """
+        Wraps the callback of a shared task to also hand its result to the
+        task registry.
+        Internal use only.
+        """
+        def onSharedDone(task, error, result):
+            callback(task, error, result)
+            self.taskRegistry.complete(key, error, result)
+
+        return onSharedDone
+
+    def _appendRunnable(self, owner, runnable, priority, *args):
+        """
+        Appends a runnable on the pool of its owner, after the delay of the
+        owner if any.
+        Internal use only.
+        """
+        pool = self._poolFor(owner)
+        delay = self.taskDataMap[owner].delay
+
+        if delay > 0:
+            threadpools.append_later(pool, delay, runnable, self.onRunnableDone, priority, *args)
+        else:
+            pool.append(runnable, self.onRunnableDone, priority, *args)
 
-    def _addRunnable(self, owner, runnable, requirements):
+    def _addRunnable(self, owner, runnable, requirements, delay = 0):
         """
         Method which schedules a runnable and its requirement
         Internal use only.
@@ -59,6 +164,7 @@ class TaskQueue(object):
             taskData = self.taskDataMap[owner]
 
             taskData.runnable = runnable
+            taskData.delay = delay
             taskData.requirementsMap = dict()
             taskData.requirements = list()
 
@@ -71,7 +177,7 @@ class TaskQueue(object):
                     self.requirementOwnerMap[r] = owner
                     self.addTask(r, self.onRequirementDone)
             else:
-                self.threadPool.append(runnable, self.onRunnableDone, 0)
+                self._appendRunnable(owner, runnable, 0)
 
     def onRunnableDone(self, runnable, error, result):
         """
@@ -87,7 +193,7 @@ class TaskQueue(object):
             if error:
                 self.onTaskDone(taskData.task, error, None)
             elif isinstance(result, tasks.deferedrun):
-                self._addRunnable(self.runnableOwnerMap[runnable], result.runnable, result.requirements)
+                self._addRunnable(self.runnableOwnerMap[runnable], result.runnable, result.requirements, result.delay)
             else:
                 self.onTaskDone(taskData.task, None, result)
 
@@ -124,6 +230,6 @@ class TaskQueue(object):
                 requirements = taskData.requirements
 
                 if all([req != NotFilled for req in requirements]):
-                    self.threadPool.append(taskData.runnable, self.onRunnableDone, len(requirements), *requirements)
+                    self._appendRunnable(owner, taskData.runnable, len(requirements), *requirements)
 
             del self.requirementOwnerMap[r]
@@ -1,13 +1,31 @@
+class TaskSkipped(Exception):
+    """
+    Raised by a task, or any of its requirements, when it could not be run but
+    the subject should go on without it rather than fail.
+    """
+    pass
+
 class deferedrun(object):
     """
     An object which may be returned from a run telling the taskqueue what the next
-    stage (runnable) is of the task and what requirements it has.
+    stage (runnable) is of the task and what requirements it has. The runnable
+    is held back delay seconds, without occupying a worker, before it is run.
     """
-    def __init__(self, runnable, requirements):
+    def __init__(self, runnable, requirements, delay = 0):
         self.runnable = runnable
         self.requirements = requirements
+        self.delay = delay
 
 class Task(object):
+    """
+    executionClass tells which lane the task's runnables are executed in,
+    "io" for the threadpool or "cpu" for a process pool when the task queue
+    has one. A "cpu" task must be picklable and give its result by returning
+    it, changes made to the task or anything it references are lost.
+    """
+
+    executionClass = "io"
+
     def preFlight(self):
         """
         The first stage of the task, will in the default implementation just
@@ -16,6 +34,14 @@ class Task(object):
         """
         return deferedrun(self.run, self.require())
 
+    def key(self):
+        """
+        Returns a hashable value identifying what the task does, or None if
+        the task is only identified by itself. Tasks with equal keys are
+        assumed to give equal results and may share one execution.
+        """
+        return None
+
     def require(self):
         """
         Return required tasks to run this task
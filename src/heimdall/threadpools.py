@@ -1,7 +1,13 @@
 from collections import deque
 from collections import namedtuple
-import json
+import copy_reg
+import cPickle as pickle
+import heapq
+import itertools
+import multiprocessing
+import types
 import threading
+import time
 import logging
 
 log = logging.getLogger("heimdall.threadpools")
@@ -12,6 +18,103 @@ class ThreadPool(object):
 
 WorkItem = namedtuple("WorkItem", [ "runnable", "callback", "priority", "args", "kwargs" ])
 
+class WorkQueue(object):
+    """
+    Heap backed queue of work items. Pops the highest priority item first and
+    items of equal priority in the order they were appended. Not locked, the
+    owning threadpool is expected to hold its condition. The time the last
+    popped item spent in queue is kept in lastWait.
+    """
+    def __init__(self):
+        self.heap = list()
+        self.counter = itertools.count()
+        self.lastWait = 0.0
+        self.waiting = dict() # Priority -> append times of its queued items
+
+    def append(self, wi):
+        now = time.time()
+        heapq.heappush(self.heap, (-wi.priority, next(self.counter), now, wi))
+        self.waiting.setdefault(wi.priority, deque()).append(now)
+
+    def pop(self):
+        entry = heapq.heappop(self.heap)
+
+        # Items of a priority are popped in the order they were appended
+        times = self.waiting[-entry[0]]
+        times.popleft()
+        if len(times) == 0:
+            del self.waiting[-entry[0]]
+
+        self.lastWait = time.time() - entry[2]
+        return entry[3]
+
+    def oldestWait(self):
+        """
+        Returns how long the oldest item in queue has waited, 0 if empty.
+        """
+        if len(self.waiting) == 0:
+            return 0.0
+        return time.time() - min(times[0] for times in self.waiting.values())
+
+    def __len__(self):
+        return len(self.heap)
+
+class DelayedScheduler(object):
+    """
+    Calls functions after a delay from one shared thread, letting work wait
+    without holding a worker of any pool.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.heap = list()
+        self.counter = itertools.count()
+        self.thread = None
+
+    def later(self, delay, function, *args):
+        with self.condition:
+            heapq.heappush(self.heap, (time.time() + delay, next(self.counter), function, args))
+
+            if self.thread == None:
+                self.thread = threading.Thread(target=self._run, name="DelayedScheduler")
+                self.thread.daemon = True
+                self.thread.start()
+
+            self.condition.notifyAll()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while len(self.heap) == 0 or self.heap[0][0] > time.time():
+                    self.condition.wait(self.heap[0][0] - time.time() if len(self.heap) > 0 else None)
+
+                due, count, function, args = heapq.heappop(self.heap)
+
+            try:
+                function(*args)
+            except Exception:
+                log.exception("Failure on delayed call of %s", str(function))
+
+# Shared by all task queues
+delayed = DelayedScheduler()
+
+def append_later(pool, delay, runnable, callback, priority, *args):
+    """
+    Appends runnable to pool after delay seconds. Until then it is counted in
+    the delayedCount of the pool, which join waits on as on queued work.
+    """
+    with pool.condition:
+        pool.delayedCount += 1
+
+    delayed.later(delay, _append_delayed, pool, runnable, callback, priority, args)
+
+def _append_delayed(pool, runnable, callback, priority, args):
+    try:
+        pool.append(runnable, callback, priority, *args)
+    finally:
+        with pool.condition:
+            pool.delayedCount -= 1
+            pool.condition.notifyAll()
+
 def safe_execute(wi):
     error = None
     result = None
@@ -20,14 +123,19 @@ def safe_execute(wi):
         result = wi.runnable(*wi.args, **wi.kwargs)
     except Exception as e:
         error = e
-        log.exception("Failure on run of %s with args %s and kwargs %s", str(wi.runnable), json.dumps(wi.args), json.dumps(wi.kwargs))
+        log.exception("Failure on run of %s with args %s and kwargs %s", str(wi.runnable), wi.args, wi.kwargs)
     finally:
-        wi.callback(wi.runnable, error, result)
+        try:
+            wi.callback(wi.runnable, error, result)
+        except Exception:
+            # Must not take the worker down with it
+            log.exception("Failure in callback of %s", str(wi.runnable))
 
 class ThreadedWorker(threading.Thread):
-    def __init__(self, owner):
+    def __init__(self, owner, daemon = False):
         super(ThreadedWorker, self).__init__()
         self.owner = owner
+        self.daemon = daemon
         self.start()
 
     def run(self):
@@ -43,8 +151,9 @@ class ThreadedWorker(threading.Thread):
 class MainloopThreadPool(object):
     def __init__(self):
         self.condition = threading.Condition()
-        self.queue = list()
+        self.queue = WorkQueue()
         self.run = True
+        self.delayedCount = 0 # Work waiting in append_later
 
     def append(self, runnable, callback, priority, *args, **kwargs):
         log.debug("append %s with args %s and kwargs %s", runnable, args, kwargs)
@@ -62,13 +171,7 @@ class MainloopThreadPool(object):
         with self.condition:
             while self.run:
                 if len(self.queue) > 0:
-                    wi = None
-                    for pi in self.queue:
-                        if wi == None or pi.priority > wi.priority:
-                            wi = pi
-                    self.queue.remove(wi)
-
-                    safe_execute(wi)
+                    safe_execute(self.queue.pop())
                 else:
                     try:
                         self.condition.wait(7)
@@ -79,8 +182,9 @@ class MainloopThreadPool(object):
 class SingleThreadedThreadPool(object):
     def __init__(self):
         self.condition = threading.Condition()
-        self.queue = list()
+        self.queue = WorkQueue()
         self.run = True
+        self.delayedCount = 0 # Work waiting in append_later
         self.worker = None
 
     def append(self, runnable, callback, priority, *args, **kwargs):
@@ -94,10 +198,7 @@ class SingleThreadedThreadPool(object):
         with self.condition:
             wi = None
             if len(self.queue) > 0 and self.run:
-                for pi in self.queue:
-                    if wi == None or pi.priority > wi.priority:
-                        wi = pi
-                self.queue.remove(wi)
+                wi = self.queue.pop()
             self.condition.notifyAll()
             return wi
 
@@ -115,14 +216,15 @@ class SingleThreadedThreadPool(object):
 
     def join(self):
         with self.condition:
-            while self.run and self.worker and len(self.queue) > 0:
+            while self.run and ((self.worker and len(self.queue) > 0) or self.delayedCount > 0):
                 self.condition.wait()
 
 class OptimisticThreadPool(object):
     def __init__(self, numberWorkers):
         self.condition = threading.Condition()
-        self.queue = list()
+        self.queue = WorkQueue()
         self.acceptNewTasks = True
+        self.delayedCount = 0 # Work waiting in append_later
         self.numberWorkers = numberWorkers
         self.workers = list()
 
@@ -139,26 +241,222 @@ class OptimisticThreadPool(object):
         with self.condition:
             wi = None
             if len(self.queue) > 0:
-                for pi in self.queue:
-                    if wi == None or pi.priority > wi.priority:
-                        wi = pi
-                self.queue.remove(wi)
-                self.condition.notifyAll()
+                wi = self.queue.pop()
+            else:
+                # Leave the pool while holding the lock, an append racing the
+                # worker exit must see the free slot and start a new worker
+                self.workers.remove(threading.current_thread())
+            self.condition.notifyAll()
             return wi
 
     def onDone(self, worker):
         with self.condition:
-            self.workers.remove(worker)
             self.condition.notifyAll()
 
     def join(self):
+        # Workers only leave once the queue is empty, and work is only
+        # appended while any is running or delayed
         with self.condition:
-            while len(self.workers) > 0 and len(self.queue) > 0:
+            while len(self.workers) > 0 or self.delayedCount > 0:
                 self.condition.wait()
 
     def quit(self):
         log.debug("Quiting threadpool")
         with self.condition:
-            self.queue = deque()
+            self.queue = WorkQueue()
             self.acceptNewTasks = False
             self.condition.notifyAll()
+
+class PersistentThreadPool(object):
+    """
+    A threadpool keeping its workers alive between bursts of work. Idle
+    workers park on the pool condition and exit after idleTimeout seconds,
+    never going below minWorkers. Up to minWorkers, and at least one, are
+    started as work is appended. Beyond that a worker is added, up to
+    maxWorkers, when the oldest item has waited in queue longer than growAfter
+    seconds, which is also checked on a timer while work is queued so the
+    pool grows even if every worker is stuck. With growAfter set to None
+    workers are added whenever no worker is idle. join blocks until the queue
+    is empty and no work is running or delayed, or until quit.
+    """
+    def __init__(self, minWorkers, maxWorkers, idleTimeout = 30.0, growAfter = 0.1):
+        self.condition = threading.Condition()
+        self.queue = WorkQueue()
+        self.run = True
+        self.delayedCount = 0 # Work waiting in append_later
+        self.minWorkers = minWorkers
+        self.maxWorkers = max(minWorkers, maxWorkers)
+        self.idleTimeout = idleTimeout
+        self.growAfter = growAfter
+        self.workers = list()
+        self.busy = set()
+        self.growthCheck = False # Is _checkGrowth scheduled?
+
+    def _idleWorkers(self):
+        return len(self.workers) - len(self.busy)
+
+    def _grow(self, limit):
+        if self._idleWorkers() < len(self.queue) and len(self.workers) < limit:
+            self.workers.append(ThreadedWorker(self, True))
+
+    def _growthLimit(self):
+        if self.growAfter == None or self.queue.oldestWait() > self.growAfter:
+            return self.maxWorkers
+        return max(self.minWorkers, 1)
+
+    def _scheduleGrowthCheck(self):
+        if self.growAfter != None and not self.growthCheck and len(self.workers) < self.maxWorkers and self._idleWorkers() < len(self.queue):
+            self.growthCheck = True
+            delayed.later(self.growAfter, self._checkGrowth)
+
+    def _checkGrowth(self):
+        with self.condition:
+            self.growthCheck = False
+            if self.run and len(self.queue) > 0:
+                self._grow(self._growthLimit())
+                self._scheduleGrowthCheck()
+
+    def append(self, runnable, callback, priority, *args, **kwargs):
+        with self.condition:
+            if self.run:
+                self.queue.append(WorkItem(runnable, callback, priority, args, kwargs))
+                self._grow(self._growthLimit())
+                self._scheduleGrowthCheck()
+                self.condition.notifyAll()
+
+    def getNextWorkItem(self):
+        worker = threading.current_thread()
+
+        with self.condition:
+            self.busy.discard(worker)
+            self.condition.notifyAll()
+
+            idleSince = time.time()
+            while self.run:
+                if len(self.queue) > 0:
+                    wi = self.queue.pop()
+                    self.busy.add(worker)
+                    if self.growAfter != None and self.queue.lastWait > self.growAfter:
+                        self._grow(self.maxWorkers)
+                    return wi
+
+                remaining = idleSince + self.idleTimeout - time.time()
+                if remaining <= 0 and len(self.workers) > self.minWorkers:
+                    break
+
+                self.condition.wait(max(remaining, 0.1) if len(self.workers) > self.minWorkers else None)
+
+            self.workers.remove(worker)
+            self.condition.notifyAll()
+            return None
+
+    def onDone(self, worker):
+        log.debug("Removing worker from threadpool")
+
+    def join(self):
+        with self.condition:
+            while self.run and (len(self.queue) > 0 or len(self.busy) > 0 or self.delayedCount > 0):
+                self.condition.wait()
+
+    def quit(self):
+        log.debug("Quiting threadpool")
+        with self.condition:
+            self.queue = WorkQueue()
+            self.run = False
+            self.condition.notifyAll()
+
+def _pickle_method(method):
+    return getattr, (method.im_self, method.im_func.__name__)
+
+# Runnables are bound methods of tasks, let them be sent to other processes
+copy_reg.pickle(types.MethodType, _pickle_method)
+
+def process_execute(job):
+    """
+    Runs a pickled runnable with its arguments in a process of a
+    ProcessThreadPool, returning the pickled error and result. Errors, also
+    those of pickling, are returned rather than raised so they always reach the
+    callback.
+    """
+    try:
+        runnable, args, kwargs = pickle.loads(job)
+        errorResult = None, runnable(*args, **kwargs)
+    except Exception as e:
+        log.exception("Failure on run in process")
+        errorResult = e, None
+
+    try:
+        return pickle.dumps(errorResult, pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        return pickle.dumps((RuntimeError("Result could not be pickled: {0}".format(e)), None), pickle.HIGHEST_PROTOCOL)
+
+def ignore(runnable, error, result):
+    pass
+
+class ProcessThreadPool(object):
+    """
+    A pool running work in separate processes, for CPU bound runnables which
+    would otherwise contend for the GIL. Runnable and arguments are pickled to
+    a worker process and the result is pickled back. Callbacks are posted to
+    callbackPool, normally the engines thread pool, so they never run on the
+    result thread of the process pool. Priority is ignored, work is run in
+    order of appending. join blocks until all work appended has been handed to
+    callbackPool, close waits for the processes to finish and ends them.
+    """
+    def __init__(self, callbackPool, numberProcesses = None):
+        self.callbackPool = callbackPool
+        self.pool = multiprocessing.Pool(numberProcesses)
+        self.condition = threading.Condition()
+        self.delayedCount = 0 # Work waiting in append_later
+        self.outstanding = 0 # Work sent to a process but not handed back
+
+    def append(self, runnable, callback, priority, *args, **kwargs):
+        try:
+            job = pickle.dumps((runnable, args, kwargs), pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            log.exception("Failed to pickle %s for a process", str(runnable))
+            self.callbackPool.append(callback, ignore, priority, runnable, e, None)
+            return
+
+        def onResult(data):
+            # Only hand over, this is the process pools result thread
+            try:
+                error, result = pickle.loads(data)
+            except Exception as e:
+                error, result = e, None
+
+            try:
+                self.callbackPool.append(callback, ignore, priority, runnable, error, result)
+            finally:
+                with self.condition:
+                    self.outstanding -= 1
+                    self.condition.notifyAll()
+
+        with self.condition:
+            self.outstanding += 1
+
+        try:
+            self.pool.apply_async(process_execute, (job, ), callback=onResult)
+        except Exception:
+            with self.condition:
+                self.outstanding -= 1
+                self.condition.notifyAll()
+            raise
+
+    def join(self):
+        with self.condition:
+            while self.delayedCount > 0 or self.outstanding > 0:
+                self.condition.wait()
+
+    def close(self):
+        """
+        Waits for the work appended to finish and ends the processes, no work
+        may be appended after.
+        """
+        self.pool.close()
+        self.pool.join()
+
+    def quit(self):
+        log.debug("Quiting process pool")
+        self.pool.terminate()
+        self.pool.join()
@@ -1,5 +1,44 @@
+import os
+import sqlite3
+
 class Enum(set):
     def __getattr__(self, name):
         if name in self:
             return name
         raise AttributeError
+
+def extends_class(Class, base):
+    """
+    Returns True if Class is base or extends it, classes are dot separated
+    paths in a tree where "item.video.Movie" extends "item.video" and "item".
+    Every class extends the empty class.
+    """
+    if base == "" or Class == base:
+        return True
+    return Class.startswith(base) and Class[len(base)] == "."
+
+def thread_connection(local, path, schema, pragmas = ()):
+    """
+    Returns the sqlite connection to the database at path of the current
+    thread, kept in the threading.local local. A new connection uses WAL, so
+    threads and processes may share the database, and runs the pragmas given
+    and the schema script, which must be safe to run again.
+    """
+    connection = getattr(local, "connection", None)
+    if connection == None:
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                pass # Created by another thread or process
+
+        connection = sqlite3.connect(path, timeout=30)
+        for pragma in ("journal_mode=WAL", "synchronous=NORMAL") + tuple(pragmas):
+            connection.execute("PRAGMA " + pragma)
+        with connection:
+            connection.executescript(schema)
+
+        local.connection = connection
+
+    return connection
@@ -0,0 +1,141 @@
+from collections import deque
+import os
+import threading
+import Queue
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+import logging
+log = logging.getLogger("heimdall.walkers")
+
+def list_folder(folder):
+    """
+    Returns the paths of files and of folders directly in folder. Symbolic
+    links to folders are not followed, as with os.walk.
+    """
+    files = list()
+    folders = list()
+
+    if scandir != None:
+        for entry in scandir(folder):
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(entry.path)
+            elif entry.is_file():
+                files.append(entry.path)
+    else:
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if os.path.isdir(path):
+                if not os.path.islink(path):
+                    folders.append(path)
+            elif os.path.isfile(path):
+                files.append(path)
+
+    return files, folders
+
+class Walker(object):
+    """
+    Lists the files below folders on a number of threads, so several subtrees
+    are listed at once which hides the latency of network shares. Files are
+    handed over through a queue of at most maxQueued paths, listing pauses
+    while it is full. If extensions is given only files with one of those
+    (lowercase, with leading dot) are listed.
+    """
+    def __init__(self, folders, extensions = None, threads = 4, maxQueued = 1024):
+        self.condition = threading.Condition()
+        self.extensions = set(extensions) if extensions != None else None
+        self.numberThreads = threads
+
+        self.folders = deque(folders)
+        self.pending = len(self.folders) # Folders waiting or being listed
+        self.stopped = False
+
+        self.files = Queue.Queue(maxQueued)
+
+    def __iter__(self):
+        if self.pending == 0:
+            return
+
+        for i in range(self.numberThreads):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+        try:
+            while True:
+                path = self.files.get()
+                if path == None:
+                    break
+                yield path
+        finally:
+            self.stop()
+
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notifyAll()
+
+        # Unblock threads waiting on a full queue
+        try:
+            while True:
+                self.files.get_nowait()
+        except Queue.Empty:
+            pass
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while len(self.folders) == 0 and self.pending > 0 and not self.stopped:
+                    self.condition.wait()
+
+                if self.pending == 0 or self.stopped:
+                    return
+
+                folder = self.folders.pop() # Depth first keeps few folders waiting
+
+            try:
+                files, folders = list_folder(folder)
+            except OSError as e:
+                log.warning("Failed to list %s: %s" % (folder, e))
+                files, folders = list(), list()
+
+            with self.condition:
+                self.folders.extend(folders)
+                self.pending += len(folders)
+                self.condition.notifyAll()
+
+            for path in files:
+                if self.extensions == None or os.path.splitext(path)[1].lower() in self.extensions:
+                    if not self._put(path):
+                        return
+
+            with self.condition:
+                self.pending -= 1
+                last = self.pending == 0
+                if last:
+                    self.condition.notifyAll()
+
+            if last:
+                self._put(None)
+
+    def _put(self, path):
+        while not self.stopped:
+            try:
+                self.files.put(path, timeout=0.5)
+                return True
+            except Queue.Full:
+                pass
+
+        return False
+
+def walk(folders, extensions = None, threads = 4, maxQueued = 1024):
+    """
+    Yields the paths of files below folders as they are found, see Walker.
+    """
+    return iter(Walker(folders, extensions, threads, maxQueued))
@@ -0,0 +1,311 @@
+from core import Subject
+from predicates import dc
+import stores
+import walkers
+
+from collections import deque
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import threading
+import time
+
+import logging
+log = logging.getLogger("heimdall.watchers")
+
+# From linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+watchMask = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+
+eventHeader = struct.Struct("iIII")
+
+try:
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    libc.inotify_init1
+    libc.inotify_add_watch.argtypes = [ ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32 ]
+    libc.inotify_rm_watch.argtypes = [ ctypes.c_int, ctypes.c_int ]
+except (OSError, AttributeError):
+    libc = None
+
+class Inotify(object):
+    """
+    Minimal ctypes binding of a Linux inotify instance.
+    """
+    def __init__(self):
+        if libc == None:
+            raise OSError(errno.ENOSYS, "inotify is not available on this platform")
+
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+
+    def addWatch(self, path, mask = watchMask):
+        wd = libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), path)
+        return wd
+
+    def removeWatch(self, wd):
+        libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout = None):
+        """
+        Returns a list of events as tuples of wd, mask, cookie and name, empty
+        if there were none within timeout seconds.
+        """
+        if len(select.select([ self.fd ], [], [], timeout)[0]) == 0:
+            return list()
+
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return list()
+            raise
+
+        events = list()
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = eventHeader.unpack_from(buf, offset)
+            offset += eventHeader.size
+            name = buf[offset:offset + length].rstrip("\0")
+            offset += length
+
+            events.append((wd, mask, cookie, name))
+
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class Watcher(object):
+    """
+    Watches folders and everything below them with inotify, processing files
+    with engine as they are written or moved in. callback is called as in
+    Engine.get for every processed file, and removed, if given, with the uri
+    of every file deleted or moved away. A file is processed once it has been
+    left alone for settle seconds after being written, so files still being
+    written are not picked up. Files moved under their own name, also along
+    with a moved folder, are moved in the engines store, if it has one, so an
+    unchanged file is answered from it instead of processed again. A file
+    given another name is processed again, its title and the searches made
+    with it come from the name. If extensions is given only files with one of
+    those are watched.
+    When inotify loses events all watched files are processed again, at most
+    maxInFlight at once.
+    """
+    def __init__(self, engine, folders, callback, removed = None, extensions = None, settle = 1.0, maxInFlight = 64):
+        self.engine = engine
+        self.folders = [ os.path.abspath(folder) for folder in folders ]
+        self.callback = callback
+        self.removed = removed
+        self.extensions = set(extensions) if extensions != None else None
+        self.settle = settle
+        self.maxInFlight = maxInFlight
+
+        self.inotify = Inotify()
+        self.watches = dict() # wd -> folder
+        self.pending = dict() # Written path -> when settled
+        self.movedFrom = dict() # Cookie -> (path, is folder, when unpaired)
+        self.order = deque() # (when, path or cookie) in order of settling
+        self.rescan = None # SubjectBatch processing everything after an overflow
+
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """
+        Starts watching on a thread of its own.
+        """
+        self.running = True
+        for folder in self.folders:
+            self._watchTree(folder)
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def run(self):
+        while self.running:
+            timeout = max(0, self.order[0][0] - time.time()) if len(self.order) > 0 else 1.0
+
+            for wd, mask, cookie, name in self.inotify.read(min(timeout, 1.0)):
+                try:
+                    self._onEvent(wd, mask, cookie, name)
+                except Exception as e:
+                    log.exception("Failed to handle event on %s: %s" % (name, e))
+
+            self._settle()
+
+        self.inotify.close()
+
+    def uriOf(self, path):
+        return stores.file_uri(path)
+
+    def _wanted(self, path):
+        return self.extensions == None or os.path.splitext(path)[1].lower() in self.extensions
+
+    def _watchTree(self, folder):
+        """
+        Watches folder and all folders below it, returns the files in them.
+        """
+        files = list()
+        folders = [ folder ]
+        while len(folders) > 0:
+            folder = folders.pop()
+            try:
+                self.watches[self.inotify.addWatch(folder)] = folder
+                found, subFolders = walkers.list_folder(folder)
+            except OSError as e:
+                log.warning("Failed to watch %s: %s" % (folder, e))
+                continue
+
+            files.extend(f for f in found if self._wanted(f))
+            folders.extend(subFolders)
+
+        return files
+
+    def _unwatchTree(self, folder):
+        prefix = folder + os.sep
+        for wd, path in self.watches.items():
+            if path == folder or path.startswith(prefix):
+                self.inotify.removeWatch(wd)
+                del self.watches[wd]
+
+    def _onEvent(self, wd, mask, cookie, name):
+        if mask & IN_Q_OVERFLOW:
+            if self.rescan != None and not self.rescan.finished:
+                log.warning("Events were lost while processing all watched files again")
+                return
+
+            log.warning("Events were lost, processing all watched files again")
+            subjects = (self._subject(path) for path in walkers.walk(self.folders, self.extensions))
+            self.rescan = self.engine.getMany(subjects, self.callback, self.maxInFlight)
+            return
+
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+
+        folder = self.watches.get(wd)
+        if folder == None or mask & IN_DELETE_SELF:
+            return
+
+        path = os.path.join(folder, name)
+        isFolder = mask & IN_ISDIR
+
+        if mask & IN_CREATE and isFolder:
+            for f in self._watchTree(path):
+                self._written(f)
+        elif mask & (IN_CLOSE_WRITE | IN_MODIFY) and not isFolder:
+            # Writes only start the wait once closed, later ones prolong it
+            if self._wanted(path) and (mask & IN_CLOSE_WRITE or path in self.pending):
+                self._written(path)
+        elif mask & IN_DELETE and not isFolder:
+            self.pending.pop(path, None)
+            if self._wanted(path):
+                self._remove(path)
+        elif mask & IN_MOVED_FROM:
+            self.pending.pop(path, None)
+            when = time.time() + self.settle
+            self.movedFrom[cookie] = (path, isFolder, when)
+            self.order.append((when, cookie))
+        elif mask & IN_MOVED_TO:
+            source = self.movedFrom.pop(cookie, None)
+            if source != None:
+                self._move(source[0], path, isFolder)
+            elif isFolder:
+                for f in self._watchTree(path):
+                    self._submit(f)
+            elif self._wanted(path):
+                self._submit(path)
+
+    def _written(self, path):
+        when = time.time() + self.settle
+        self.pending[path] = when
+        self.order.append((when, path))
+
+    def _settle(self):
+        now = time.time()
+        while len(self.order) > 0 and self.order[0][0] <= now:
+            when, key = self.order.popleft()
+
+            if self.pending.get(key) == when:
+                del self.pending[key]
+                self._submit(key)
+            elif key in self.movedFrom and self.movedFrom[key][2] == when:
+                path, isFolder, when = self.movedFrom.pop(key)
+                if isFolder:
+                    self._unwatchTree(path)
+                if isFolder or self._wanted(path):
+                    self._remove(path)
+
+    def _subject(self, path):
+        metadata = dict()
+        metadata[dc.identifier] = self.uriOf(path)
+        return Subject("", metadata)
+
+    def _submit(self, path):
+        self.engine.get(self._subject(path), self.callback)
+
+    def _remove(self, path):
+        store = self.engine.store
+        removed = store.remove(self.uriOf(path)) if store != None else [ self.uriOf(path) ]
+
+        if self.removed:
+            for uri in removed:
+                self.removed(uri)
+
+    def _move(self, path, newPath, isFolder):
+        if isFolder:
+            prefix = path + os.sep
+            for wd, folder in self.watches.items():
+                if folder == path or folder.startswith(prefix):
+                    self.watches[wd] = newPath + folder[len(path):]
+
+            paths = list(walkers.walk([ newPath ], self.extensions))
+        elif self._wanted(newPath) and os.path.basename(newPath) != os.path.basename(path):
+            # What was derived from the old name is stale
+            self._remove(path)
+            self._submit(newPath)
+            return
+        elif self._wanted(newPath):
+            paths = [ newPath ]
+        else:
+            self._remove(path)
+            return
+
+        store = self.engine.store
+        if store != None:
+            moved = store.move(self.uriOf(path), self.uriOf(newPath))
+        else:
+            moved = [ (self.uriOf(path + p[len(newPath):]), self.uriOf(p)) for p in paths ]
+
+        if self.removed:
+            for uri, newUri in moved:
+                self.removed(uri)
+
+        # Unchanged files are answered from the store under their new uri
+        for p in paths:
+            self._submit(p)
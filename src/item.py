@@ -4,6 +4,7 @@ from heimdall import resources
 from heimdall import supplies, demands
 from heimdall.predicates import *
 
+import urllib
 import urlparse
 
 mime_types = {
@@ -32,7 +33,7 @@ class ItemPredicateObject(tasks.SubjectTask):
     ]
 
     def run(self):
-        path = urlparse.urlparse(self.subject[dc.identifier]).path
+        path = urllib.unquote(urlparse.urlparse(self.subject[dc.identifier]).path)
         ext = path[path.rindex("."):].lower()
         mime_type = mime_types.get(ext, None)
 
@@ -6,7 +6,55 @@ from heimdall.predicates import *
 
 from pymediainfo import MediaInfo
 
-from urlparse import urlparse
+from heimdall.stores import local_path
+
+class ParseMediaInfo(tasks.Task):
+    """
+    Parses the streams of a media file, CPU bound so it is run in the cpu lane.
+    Gives the duration in seconds and lists of video and audio stream dicts.
+    """
+
+    executionClass = "cpu"
+
+    def __init__(self, path):
+        self.path = path
+
+    def run(self):
+        media_info = MediaInfo.parse(self.path)
+
+        duration = None
+        video_streams = list()
+        audio_streams = list()
+
+        for track in media_info.tracks:
+            if track.track_type == 'General' and track.duration:
+                duration = track.duration / 1000.0
+            elif track.track_type == 'Video':
+                v = dict()
+
+                if track.frame_rate:
+                    v["framerate"] = float(track.frame_rate)
+                if track.codec:
+                    v["codec"] = track.codec
+                if track.height:
+                    v["height"] = int(track.height)
+                if track.width:
+                    v["width"] = int(track.width)
+
+                video_streams.append(v)
+            elif track.track_type == "Audio":
+                a = dict()
+
+                if track.sampling_rate:
+                    a["samplerate"] = int(track.sampling_rate)
+                if track.codec:
+                    a["codec"] = track.codec
+                if track.channel_s:
+                    a["channels"] = int(track.channel_s)
+
+                audio_streams.append(a)
+
+        return duration, video_streams, audio_streams
 
 class ExtractStreamDetails(tasks.SubjectTask):
     demand = [
@@ -21,42 +69,18 @@ class ExtractStreamDetails(tasks.SubjectTask):
         supplies.emit("audio_stream")
     ]
 
-    def run(self):
-        uri = urlparse(self.subject[dc.identifier]).path
+    def require(self):
+        uri = local_path(self.subject[dc.identifier])
 
         if uri:
-            media_info = MediaInfo.parse(uri)
-
-            video_streams = list()
-            audio_streams = list()
-
-            for track in media_info.tracks:
-                if track.track_type == 'General' and track.duration:
-                    self.subject.emit("duration", track.duration / 1000.0)
-                elif track.track_type == 'Video':
-                    v = dict()
-
-                    if track.frame_rate:
-                        v["framerate"] = float(track.frame_rate)
-                    if track.codec:
-                        v["codec"] = track.codec
-                    if track.height:
-                        v["height"] = int(track.height)
-                    if track.width:
-                        v["width"] = int(track.width)
-
-                    video_streams.append(v)
-                elif track.track_type == "Audio":
-                    a = dict()
-
-                    if track.sampling_rate:
-                        a["samplerate"] = int(track.sampling_rate)
-                    if track.codec:
-                        a["codec"] = track.codec
-                    if track.channel_s:
-                        a["channels"] = int(track.channel_s)
-
-                    audio_streams.append(a)
+            return ParseMediaInfo(uri)
+
+    def run(self, streams = None):
+        if streams:
+            duration, video_streams, audio_streams = streams
+
+            if duration:
+                self.subject.emit("duration", duration)
 
             for v in video_streams:
                 self.subject.emit("video_stream", v)
@@ -4,6 +4,10 @@
 from heimdall.core import Engine, Subject
 from heimdall.predicates import *
 from heimdall.threadpools import *
+from heimdall.stores import ResultStore, ScanJournal, file_uri
+from heimdall.walkers import walk
+from heimdall.sinks import JsonLinesSink
+from heimdall import resources
 
 import themoviedb
 import theaudiodb
@@ -11,9 +15,11 @@ import item
 import video_item
 import audio_item
 import media_item
+import game_item
 import json
 
 import time
+import hashlib
 from urlparse import urlparse
 from urlparse import urlsplit, urlunsplit
 from urllib import quote_plus, unquote_plus
@@ -24,54 +30,63 @@ import logging
 logging.basicConfig()
 logging.getLogger("heimdall").setLevel(logging.DEBUG)
 
-def main(folder):
-    print "Running heimdall on folder", folder
+# Results of earlier runs, files unchanged since are not processed again
+defaultStorePath = os.path.join(os.path.expanduser("~"), ".heimdall", "results.db")
+
+def journalPath(folder):
+    """
+    Returns where the journal of an interrupted scan of folder is kept.
+    """
+    name = hashlib.sha1(os.path.abspath(folder)).hexdigest() + ".journal"
+    return os.path.join(os.path.expanduser("~"), ".heimdall", "scans", name)
+
+def main(folder, storePath = defaultStorePath):
+    print >> sys.stderr, "Running heimdall on folder", folder
     pool = MainloopThreadPool()
-    engine = Engine(pool)
+    resources.configure_http(poolSize=1) # Resources are only read on the main loop
+    engine = Engine(pool, store=ResultStore(storePath))
     engine.registerModule(themoviedb.module)
     engine.registerModule(theaudiodb.module)
     engine.registerModule(item.module)
     engine.registerModule(video_item.module)
     engine.registerModule(audio_item.module)
     engine.registerModule(media_item.module)
+    engine.registerModule(game_item.module)
 
-    subjects = list()
-
-    fileList = []
-    for root, subFolders, files in os.walk(folder):
-        for f in files:
-            p = os.path.join("file://", root, f)
-            fileList.append(p)
-
-    print "Files to process", len(fileList)
+    # Only files some module knows how to handle
+    extensions = set(item.mime_types.keys())
+    extensions.update("." + ext for ext in game_item.ext_to_platform.keys())
 
-    fileList = fileList[:]
-
-    nbrBeforeQuit = len(fileList)
+    # Subjects are streamed to stdout as JSON lines and released once written
+    sink = JsonLinesSink(sys.stdout, syncInterval=None)
+    engine.addSink(sink)
 
     def c(error, subject):
         if error:
             raise error
 
-        print subject
-        subjects.append(subject)
-
-        if len(subjects) >= nbrBeforeQuit:
-            pool.quit()
+    def done():
+        sink.close()
+        pool.quit()
 
-    for uri in fileList:
-        metadata = dict()
-        metadata[dc.identifier] = uri
-        subject = Subject("", metadata)
+    def subjectsOf(paths):
+        for path in paths:
+            metadata = dict()
+            metadata[dc.identifier] = file_uri(path)
+            yield Subject("", metadata)
 
-        engine.get(subject, c)
+    # Resumes the scan if an earlier one of folder was interrupted
+    journal = ScanJournal(journalPath(folder))
+    engine.getMany(subjectsOf(walk([folder], extensions)), c, 64, done, journal)
 
     try:
         pool.join()
     except KeyboardInterrupt:
         pool.quit()
+        journal.close()
+        sink.close()
 
-    print "done"
+    print >> sys.stderr, "done"
 
 if __name__ == "__main__":
-    main(sys.argv[1])
+    main(*sys.argv[1:3])
@@ -0,0 +1,24 @@
+from heimdall import caches
+
+import os
+import shutil
+import tempfile
+import unittest
+
+class DiskCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.cache = caches.DiskCache(os.path.join(self.folder, "cache.db"), maxBytes=100)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def testValueLargerThanCache(self):
+        self.cache.put("small", "x" * 50)
+        self.cache.put("large", "y" * 500)
+
+        self.assertEqual(self.cache.get("small"), "x" * 50)
+        self.assertEqual(self.cache.get("large"), None)
+
+if __name__ == "__main__":
+    unittest.main()
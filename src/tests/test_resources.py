@@ -0,0 +1,59 @@
+from heimdall import hosts, resources, tasks
+
+import time
+import unittest
+
+class FakeResource(object):
+    def __init__(self, uri):
+        self.uri = uri
+
+    def read(self):
+        return "answer"
+
+class BreakerProbeTest(unittest.TestCase):
+    uri = "http://probe.test/resource"
+
+    def setUp(self):
+        hosts.limit_host("probe.test", concurrency=1)
+        hosts.breakers.pop("probe.test", None)
+        resources.memoryCache.invalidate(self.uri)
+
+    def tearDown(self):
+        hosts.limits.pop("probe.test", None)
+        hosts.breakers.pop("probe.test", None)
+
+    def testProbeDeferredByHostLimit(self):
+        breaker = hosts.breaker_for(self.uri)
+        for i in range(breaker.threshold):
+            breaker.failure()
+        breaker.openUntil = time.time() - 1 # Cooldown is over
+
+        limit = hosts.limit_for(self.uri)
+        self.assertEqual(limit.acquire(), 0) # Hold the only slot
+
+        resource = resources.SimpleResource(self.uri)
+        deferred = resource.run(FakeResource(self.uri))
+        self.assertTrue(isinstance(deferred, tasks.deferedrun))
+        self.assertFalse(breaker.probing)
+
+        limit.release()
+        self.assertEqual(deferred.runnable(), "answer")
+        self.assertEqual(breaker.openUntil, None)
+        self.assertTrue(breaker.allow())
+
+class KeyTest(unittest.TestCase):
+    uri = "http://key.test/resource"
+
+    def testKeyedOnClass(self):
+        class SimpleResource(resources.SimpleResource):
+            pass
+
+        self.assertEqual(resources.SimpleResource(self.uri).key(), resources.SimpleResource(self.uri).key())
+        self.assertNotEqual(SimpleResource(self.uri).key(), resources.SimpleResource(self.uri).key())
+
+    def testInvalidateCacheNotShared(self):
+        self.assertNotEqual(resources.CachedSimpleResource(self.uri).key(), None)
+        self.assertEqual(resources.CachedSimpleResource(self.uri, invalidateCache=True).key(), None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+from heimdall import threadpools
+
+import time
+import unittest
+
+class WorkQueueTest(unittest.TestCase):
+    def item(self, priority):
+        return threadpools.WorkItem(None, None, priority, (), {})
+
+    def testOldestWait(self):
+        queue = threadpools.WorkQueue()
+        queue.append(self.item(0))
+        time.sleep(0.1)
+        for i in range(1000):
+            queue.append(self.item(1))
+            queue.pop()
+
+        self.assertTrue(queue.oldestWait() >= 0.1)
+        self.assertEqual(sum(len(times) for times in queue.waiting.values()), 1)
+
+        queue.pop()
+        self.assertEqual(queue.oldestWait(), 0.0)
+        self.assertEqual(len(queue.waiting), 0)
+
+class DelayedJoinTest(unittest.TestCase):
+    def runDelayed(self, pool):
+        done = list()
+
+        def work():
+            return time.time()
+
+        def callback(runnable, error, result):
+            done.append(result)
+
+        start = time.time()
+        threadpools.append_later(pool, 0.3, work, callback, 0)
+        pool.join()
+
+        self.assertEqual(len(done), 1)
+        self.assertTrue(done[0] - start >= 0.3)
+        self.assertEqual(pool.delayedCount, 0)
+
+    def testOptimisticJoinWaitsForDelayed(self):
+        self.runDelayed(threadpools.OptimisticThreadPool(2))
+
+    def testPersistentJoinWaitsForDelayed(self):
+        pool = threadpools.PersistentThreadPool(0, 2)
+        try:
+            self.runDelayed(pool)
+        finally:
+            workers = list(pool.workers)
+            pool.quit()
+            for worker in workers:
+                worker.join()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,7 @@
 import heimdall
 from heimdall import tasks
 from heimdall import resources
+from heimdall import hosts
 from heimdall import supplies, demands
 from heimdall.predicates import *
 
@@ -13,6 +14,17 @@ api_key = "78626d636d76696473706c"
 tadb_api_base = "http://www.theaudiodb.com/api/v1/json/{0}/".format(api_key)
 tadb_base = "http://www.theaudiodb.com/"
 
+# Be gentle on TheAudioDB, its free API is rate limited
+hosts.limit_host("www.theaudiodb.com", rate=2, burst=5, concurrency=2)
+
+def no_artists(result):
+    artists = json.loads(result).get("artists")
+    return type(artists) != types.ListType or len(artists) == 0
+
+def no_albums(result):
+    albums = json.loads(result).get("album")
+    return type(albums) != types.ListType or len(albums) == 0
+
 class ArtistPredicateObject(tasks.SubjectTask):
     demand = [
         demands.required(dc.identifier, tadb_base + "artist/")
@@ -91,7 +103,7 @@ class SearchArtist(tasks.SubjectTask):
 
         path = "http://www.theaudiodb.com/api/v1/json/{0}/search.php?s={1}".format(api_key, quote_plus(title))
 
-        return resources.SimpleResource(path)
+        return resources.SearchResource(path, no_artists)
 
     def run(self, resource):
         result = json.loads(resource)
@@ -122,7 +134,7 @@ class SearchAlbum(tasks.SubjectTask):
 
         path = "http://www.theaudiodb.com/api/v1/json/{0}/searchalbum.php?s={1}&a={2}".format(api_key, quote_plus(artist), quote_plus(album))
 
-        return resources.SimpleResource(path)
+        return resources.SearchResource(path, no_albums)
 
     def run(self, resource):
         result = json.loads(resource)
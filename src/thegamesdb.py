@@ -1,6 +1,7 @@
 import heimdall
 from heimdall import tasks
 from heimdall import resources
+from heimdall import hosts
 from heimdall import supplies, demands
 from heimdall.predicates import *
 
@@ -9,7 +10,6 @@ from game_item import game, comparePlatforms
 import datetime
 import difflib
 import os, glob
-import urllib
 from urllib import quote_plus
 import xml.etree.ElementTree as ET
 
@@ -17,6 +17,9 @@ thegamesdb = PredicateBuilder("thegamesdb", "http://thegamesdb.net/#", [ "identi
 
 baseImageUrl = "http://thegamesdb.net/banners/"
 
+# Be gentle on TheGamesDB, its API is rate limited
+hosts.limit_host("thegamesdb.net", rate=1, burst=3, concurrency=2)
+
 class TranslatePlatform(tasks.SubjectTask):
     demand = [
         demands.required(game.platform)
@@ -49,7 +52,11 @@ def downloadArtwork(url, folder, title):
         newFile = os.path.join(folder, "%s%s" % (title, fileExtension))
         print "File does not exist. Start download: " + newFile
         try:
-            urllib.urlretrieve(url, newFile)
+            status, headers, body = resources.http_get(url)
+            if status != 200:
+                raise IOError("HTTP status %d" % status)
+            with open(newFile, "wb") as f:
+                f.write(body)
         except Exception, (exc):
             print "Could not create file: '%s'. Error message: '%s'" % (newFile, str(exc))
     else:
@@ -87,81 +94,71 @@ class DownloadFanart(tasks.SubjectTask):
         title = self.subject[dc.title]
         downloadArtwork(url, folder, title)
 
-class GamePredicateObject(tasks.SubjectTask):
-    demand = [
-#        demands.required(thegamesdb.identifier, "http://thegamesdb.net/api/GetGame.php?id=")
-        demands.required(dc.title),
-        demands.requiredClass("item.game"),
-        demands.required(thegamesdb.platform)
-    ]
+class FindGame(tasks.Task):
+    """
+    Parses a GetGame.php search and picks the game closest to title. CPU bound
+    so it is run in the cpu lane, gives a list of (method, predicate, object)
+    changes to apply on the subject.
+    """
 
-    supply = [
-        supplies.emit(thegamesdb.identifier),
-        supplies.replace(dc.title),
-        supplies.emit(dc.type),
-        supplies.emit(dc.description),
-        supplies.emit(dc.date),
-        supplies.emit(media.rating),
-        supplies.emit(game.developer),
-        supplies.emit(game.publisher),
-        supplies.emit(game.players),
-        supplies.emit(foaf.thumbnail),
-        supplies.emit("fanart"),
-        supplies.emit("banner"),
-        supplies.emit(video.trailer),
-    ]
+    executionClass = "cpu"
+
+    def __init__(self, path, title):
+        self.path = path
+        self.title = title
 
     def require(self):
-        title = self.subject[dc.title]
-        platform = self.subject[thegamesdb.platform]
-        path = "http://thegamesdb.net/api/GetGame.php?name=%s&platform=%s" % (quote_plus(title), quote_plus(platform))
-        return resources.SimpleResource(path)
+        return resources.SimpleResource(self.path)
 
     def run(self, resource):
+        changes = list()
+
         root = ET.fromstring(resource)
         gameRows = root.findall("Game")
 
         # TheGamesDB has search ordering problems. Sucks for XML scrapers... not for us!
         possibilities = [self.readTextElement(gameRow, "GameTitle") for gameRow in gameRows]
-        gameTitle = difflib.get_close_matches(self.subject[dc.title], possibilities, 1)
+        gameTitle = difflib.get_close_matches(self.title, possibilities, 1)
         if gameTitle:
             gameTitle = gameTitle[0]
             for gameRow in gameRows:
                 if gameTitle != self.readTextElement(gameRow, "GameTitle"):
                     continue
                 gameid = self.readTextElement(gameRow, "id")
-                self.subject.emit(thegamesdb.identifier, "http://thegamesdb.net/api/GetGame.php?id=%s" % gameid)
-                self.subject.replace(dc.title, gameTitle)
+                changes.append(("emit", thegamesdb.identifier, "http://thegamesdb.net/api/GetGame.php?id=%s" % gameid))
+                changes.append(("replace", dc.title, gameTitle))
                 for genre in gameRow.findall("Genres/genre"):
-                    self.subject.emit(dc.type, genre.text)
-                self.subject.emit(dc.description, self.readTextElement(gameRow, "Overview"))
+                    changes.append(("emit", dc.type, genre.text))
+                changes.append(("emit", dc.description, self.readTextElement(gameRow, "Overview")))
                 try:
                     # Deserialize MM/DD/YYYY
                     dateobject = datetime.datetime.strptime(self.readTextElement(gameRow, "ReleaseDate"), "%m/%d/%Y")
-                    self.subject.emit(dc.date, dateobject.strftime("%Y-%m-%d"))
+                    changes.append(("emit", dc.date, dateobject.strftime("%Y-%m-%d")))
                 except ValueError:
                     # can't be parsed by strptime()
                     pass
-                self.subject.emit(media.rating, self.readTextElement(gameRow, 'ESRB'))
-                self.subject.emit(game.developer, self.readTextElement(gameRow, 'Developer'))
-                self.subject.emit(game.publisher, self.readTextElement(gameRow, 'Publisher'))
-                self.subject.emit(game.players, self.readTextElement(gameRow, 'Players'))
+                changes.append(("emit", media.rating, self.readTextElement(gameRow, 'ESRB')))
+                changes.append(("emit", game.developer, self.readTextElement(gameRow, 'Developer')))
+                changes.append(("emit", game.publisher, self.readTextElement(gameRow, 'Publisher')))
+                changes.append(("emit", game.players, self.readTextElement(gameRow, 'Players')))
 
                 for boxartRow in gameRow.findall('Images/boxart'):
                     side = boxartRow.attrib.get('side')
                     if side == 'front' and boxartRow.text:
-                        self.subject.emit(foaf.thumbnail, baseImageUrl + boxartRow.text)
+                        changes.append(("emit", foaf.thumbnail, baseImageUrl + boxartRow.text))
                 for fanartRow in gameRow.findall('Images/fanart'):
                     original = self.readTextElement(fanartRow, 'original')
                     if original:
                         thumb = self.readTextElement(fanartRow, 'thumb')
                         if thumb:
-                            self.subject.emit("fanart", {"fanart": baseImageUrl + original, "thumbnail": baseImageUrl + thumb})
+                            changes.append(("emit", "fanart", {"fanart": baseImageUrl + original, "thumbnail": baseImageUrl + thumb}))
                         else:
-                            self.subject.emit("fanart", baseImageUrl + original)
+                            changes.append(("emit", "fanart", baseImageUrl + original))
                 for bannerRow in gameRow.findall('Images/banner'):
-                    self.subject.emit("banner", baseImageUrl + bannerRow.text)
-                self.subject.emit(video.trailer, self.readTextElement(gameRow, 'Youtube'))
+                    changes.append(("emit", "banner", baseImageUrl + bannerRow.text))
+                changes.append(("emit", video.trailer, self.readTextElement(gameRow, 'Youtube')))
+
+        return changes
 
     def readTextElement(self, parent, elementName):
         element = parent.find(elementName)
@@ -170,4 +167,38 @@ class GamePredicateObject(tasks.SubjectTask):
         else:
             return ''
 
+class GamePredicateObject(tasks.SubjectTask):
+    demand = [
+#        demands.required(thegamesdb.identifier, "http://thegamesdb.net/api/GetGame.php?id=")
+        demands.required(dc.title),
+        demands.requiredClass("item.game"),
+        demands.required(thegamesdb.platform)
+    ]
+
+    supply = [
+        supplies.emit(thegamesdb.identifier),
+        supplies.replace(dc.title),
+        supplies.emit(dc.type),
+        supplies.emit(dc.description),
+        supplies.emit(dc.date),
+        supplies.emit(media.rating),
+        supplies.emit(game.developer),
+        supplies.emit(game.publisher),
+        supplies.emit(game.players),
+        supplies.emit(foaf.thumbnail),
+        supplies.emit("fanart"),
+        supplies.emit("banner"),
+        supplies.emit(video.trailer),
+    ]
+
+    def require(self):
+        title = self.subject[dc.title]
+        platform = self.subject[thegamesdb.platform]
+        path = "http://thegamesdb.net/api/GetGame.php?name=%s&platform=%s" % (quote_plus(title), quote_plus(platform))
+        return FindGame(path, title)
+
+    def run(self, changes):
+        for method, predicate, object in changes:
+            getattr(self.subject, method)(predicate, object)
+
 module = [ TranslatePlatform, GamePredicateObject, DownloadBoxfront, DownloadFanart ]
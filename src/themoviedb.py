@@ -1,6 +1,7 @@
 import heimdall
 from heimdall import tasks
 from heimdall import resources
+from heimdall import hosts
 from heimdall import supplies, demands
 from heimdall.predicates import *
 
@@ -10,6 +11,12 @@ from urllib import unquote_plus, quote_plus
 tmdb_api_base = "http://api.themoviedb.org/3/"
 tmdb_base = "http://themoviedb.org/"
 
+# TheMovieDB allows 40 requests every 10 seconds and 20 connections at once
+hosts.limit_host("api.themoviedb.org", rate=4, burst=40, concurrency=20)
+
+def no_movies(result):
+    return len(json.loads(result).get("results", [])) == 0
+
 class MoviePredicateObject(tasks.SubjectTask):
     demand = [
         demands.required(dc.identifier, tmdb_base + "movie/")
@@ -67,7 +74,7 @@ class SearchMovieCollector(tasks.SubjectTask):
         title = self.subject[dc.title]
         path = "http://api.themoviedb.org/3/search/movie?api_key=57983e31fb435df4df77afb854740ea9&query=" + quote_plus(title)
 
-        return resources.SimpleResource(path)
+        return resources.SearchResource(path, no_movies)
 
     def run(self, resource):
         result = json.loads(resource)
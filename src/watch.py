@@ -0,0 +1,67 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+from heimdall.core import Engine
+from heimdall.predicates import *
+from heimdall.threadpools import *
+from heimdall.stores import ResultStore
+from heimdall.watchers import Watcher
+from heimdall import resources
+
+import themoviedb
+import theaudiodb
+import item
+import video_item
+import audio_item
+import media_item
+import game_item
+
+import recurse
+
+import sys
+
+import logging
+logging.basicConfig()
+logging.getLogger("heimdall").setLevel(logging.DEBUG)
+
+def main(folder, storePath = recurse.defaultStorePath):
+    print "Watching heimdall on folder", folder
+    maxWorkers = 16
+    pool = PersistentThreadPool(4, maxWorkers)
+    resources.configure_http(poolSize=maxWorkers) # A connection for every worker
+    engine = Engine(pool, store=ResultStore(storePath))
+    engine.registerModule(themoviedb.module)
+    engine.registerModule(theaudiodb.module)
+    engine.registerModule(item.module)
+    engine.registerModule(video_item.module)
+    engine.registerModule(audio_item.module)
+    engine.registerModule(media_item.module)
+    engine.registerModule(game_item.module)
+
+    # Only files some module knows how to handle
+    extensions = set(item.mime_types.keys())
+    extensions.update("." + ext for ext in game_item.ext_to_platform.keys())
+
+    def c(error, subject):
+        if error:
+            print "Failed", error
+        else:
+            print subject
+
+    def removed(uri):
+        print "Removed", uri
+
+    watcher = Watcher(engine, [folder], c, removed, extensions)
+    watcher.start()
+
+    try:
+        while True:
+            watcher.thread.join(1)
+    except KeyboardInterrupt:
+        watcher.stop()
+        pool.quit()
+
+    print "done"
+
+if __name__ == "__main__":
+    main(*sys.argv[1:3])